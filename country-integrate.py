@@ -1,14 +1,24 @@
+import numpy as np
 import pandas as pd
 import glob
+import itertools
+import json
+import multiprocessing
 import os
+import re
+import shutil
+import sqlite3
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from openpyxl import Workbook
 
 # ================= 設定區 =================
 
 # 1. 取得腳本所在的基本路徑 (Base Path)
 if getattr(sys, 'frozen', False):
     base_path = os.path.dirname(sys.executable)
-elif '__file__' in locals():
+elif '__file__' in globals():
     base_path = os.path.dirname(os.path.abspath(__file__))
 else:
     base_path = os.getcwd()
@@ -17,40 +27,535 @@ else:
 target_folder_name = "data-2015-2024"
 input_path = os.path.join(base_path, target_folder_name)
 
+# 3. Excel 單一工作表列數上限（含表頭），寫滿就換下一張工作表
+MAX_EXCEL_ROWS = 1_048_576
+
+# 4. 平行讀取各國 Excel 的 process 數（1 = 依序讀取）；寫出仍依檔案順序
+WORKERS = 1
+
+# 5. 是否另外輸出依 COUNTRY / YEAR 分區的 Parquet 資料集（需要 pyarrow，沒裝就略過）
+PARQUET_OUTPUT = False
+PARTITION_COLS = ["COUNTRY", "YEAR"]
+
+# 6. 型別化輸出：變數欄轉成浮點數、識別欄轉成 category，缺值一律 NaN
+#    CSV / Parquet 缺值留空；只有 Excel 才把缺值寫回 "."（與 variable-integrate.py 相同）
+#    False 時維持全部字串（dtype=str）
+TYPED_OUTPUT = False
+FLOAT_DTYPE = "float64"             # 記憶體吃緊可改 "float32"（約 7 位有效數字）
+MISSING_VALUES = ["", ".", "NA"]    # "." 是 variable-integrate.py 補的缺值，"NA" 是 Datastream 的缺值
+ID_COLUMNS = ["COUNTRY", "COUNTRY_CODE", "COUNTRY_CODE2", "Type"]
+
+# 7. 是否另外輸出 SQLite 資料庫（all-Ncountries.sqlite，資料表 panel）
+#    載入完才建 (COUNTRY, YEAR) 與 (Type, YEAR) 索引，查單一公司 / 國家年度不必掃整份 CSV
+SQLITE_OUTPUT = False
+SQLITE_BATCH = 10_000               # 每次 executemany 的列數
+
+# 8. 是否另外輸出長表（all-Ncountries-long.csv：DSCD, YEAR, VARIABLE_ID, VALUE），缺值不寫
+#    VARIABLE_ID 對照表另存 all-Ncountries-variables.csv；變數越稀疏，檔案越小
+LONG_OUTPUT = False
+
+# 9. 是否另外輸出 firm × year 的變數陣列（all-Ncountries-panel/，每個變數一個 .npy）
+#    numpy.load(..., mmap_mode="r") 直接對應到檔案，不必讀整份 CSV 再 pivot
+PANEL_ARRAYS = False
+
 # ==========================================
 
-print(f"程式位置: {base_path}")
-print(f"正在搜尋資料夾: {input_path}")
-print("-" * 30)
+class IndexedCsvWriter:
+    """
+    逐國 append 寫 CSV，同時記錄每個國家、每個年度區塊的 byte 位置，存成 all-Ncountries.index.json
+    - 表頭單獨寫一次，記錄 [0, 表頭結尾)，讀取端把表頭與區塊 bytes 接起來即可直接 parse
+    - 每個區塊記 [offset, length, rows]；同一年在檔案中不連續時會有多段
+    - 每寫完一個國家就更新索引（暫存檔 + 改名），中斷時索引仍對應已寫入的部分
+    - 搭配 csv-extract.py：seek 到指定區塊讀取，不必掃過整份 CSV
+    """
+    def __init__(self, csv_path, index_path):
+        self.csv_path = csv_path
+        self.index_path = index_path
+        self.float_format = ("%.7g" if FLOAT_DTYPE == "float32" else "%.15g") if TYPED_OUTPUT else None
+        self.index = {
+            "csv": os.path.basename(csv_path),
+            "encoding": "utf-8-sig",
+            "header": None,
+            "countries": {},
+        }
+        if os.path.exists(index_path):
+            with open(index_path, "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+
+    def _write(self, df, header=False):
+        start = os.path.getsize(self.csv_path) if os.path.exists(self.csv_path) else 0
+        df.to_csv(
+            self.csv_path, mode='a', index=False, header=header, encoding='utf-8-sig',
+            float_format=self.float_format,
+        )
+        return [start, os.path.getsize(self.csv_path) - start, len(df)]
+
+    def append_frame(self, df, source):
+        if not os.path.isfile(self.csv_path):
+            offset, length, _ = self._write(df.head(0), header=True)
+            self.index["header"] = [offset, length]
+
+        # 依 YEAR 切成連續區段分別寫入（bytes 與一次寫整個國家相同）
+        years = {}
+        if "YEAR" in df.columns and len(df):
+            runs = df["YEAR"].ne(df["YEAR"].shift()).cumsum()
+            blocks = []
+            for _, part in df.groupby(runs, sort=False):
+                block = self._write(part)
+                years.setdefault(str(part["YEAR"].iloc[0]), []).append(block)
+                blocks.append(block)
+            offset = blocks[0][0]
+            length = blocks[-1][0] + blocks[-1][1] - offset
+        else:
+            offset, length, _ = self._write(df)
+
+        country = str(df["COUNTRY"].iloc[0]) if "COUNTRY" in df.columns and len(df) else os.path.splitext(source)[0]
+        self.index["countries"].setdefault(country, []).append({
+            "file": source,
+            "offset": offset,
+            "length": length,
+            "rows": len(df),
+            "years": years,
+        })
+        self.save()
+
+    def save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+class ExcelShardWriter:
+    """
+    合併的同時以 write-only 逐列寫出 xlsx，不必事後重讀整份 CSV
+    - 工作表寫滿 MAX_EXCEL_ROWS 列就自動換下一張（Sheet1、Sheet2...），每張都有表頭
+    - 表頭沿用第一個寫入的 DataFrame 欄位（已對齊到欄位聯集，與 CSV 相同）
+    - 型別化輸出時缺值寫成 "."，數值欄寫成數字儲存格
+    - 先寫暫存檔，完成後才改名，避免留下寫到一半的 xlsx
+    """
+    def __init__(self, path):
+        self.path = path
+        self.wb = Workbook(write_only=True)
+        self.header = None
+        self.ws = None
+        self.sheet_rows = 0     # 目前工作表已寫列數（含表頭）
+        self.total_rows = 0     # 全部資料列數（不含表頭）
+
+    def _new_sheet(self):
+        self.ws = self.wb.create_sheet(f"Sheet{len(self.wb.sheetnames) + 1}")
+        self.ws.append(self.header)
+        self.sheet_rows = 1
+
+    def append_frame(self, df):
+        if self.header is None:
+            self.header = list(df.columns)
+
+        values = df.astype(object).where(df.notna(), "." if TYPED_OUTPUT else None)
+        for row in values.itertuples(index=False, name=None):
+            if self.ws is None or self.sheet_rows >= MAX_EXCEL_ROWS:
+                self._new_sheet()
+            self.ws.append(row)
+            self.sheet_rows += 1
+            self.total_rows += 1
+
+    def save(self):
+        if self.ws is None:
+            self._new_sheet()
+        tmp_path = self.path + ".tmp"
+        self.wb.save(tmp_path)
+        os.replace(tmp_path, self.path)
+        return len(self.wb.sheetnames)
+
+class LongCsvWriter:
+    """
+    寬表轉長表逐國 append：每個非缺值儲存格一列 (DSCD, YEAR, VARIABLE_ID, VALUE)
+    - DSCD 即寬表的 Type 欄
+    - 缺值（NaN、""、"."、"NA"）直接略過
+    - 變數名稱編成從 1 開始的整數，對照表（VARIABLE_ID, VARIABLE）在建立時就寫好
+    - 列順序與寬表相同（公司年度優先，同一列內依欄位順序）
+    """
+    def __init__(self, path, dict_path, columns):
+        self.path = path
+        self.variables = [c for c in columns if c != "YEAR" and c not in ID_COLUMNS]
+        self.var_ids = np.arange(1, len(self.variables) + 1)
+        self.float_format = ("%.7g" if FLOAT_DTYPE == "float32" else "%.15g") if TYPED_OUTPUT else None
+        self.cells = 0          # 寫出的儲存格數
+        self.skipped = 0        # 略過的缺值數
+
+        pd.DataFrame({"VARIABLE_ID": self.var_ids, "VARIABLE": self.variables}).to_csv(
+            dict_path, index=False, encoding='utf-8-sig'
+        )
+
+    def append_frame(self, df):
+        values = df[self.variables].astype(object)
+        mask = (values.notna() & ~values.isin(MISSING_VALUES)).to_numpy()
+        rows, cols = np.nonzero(mask)
+        cells = values.to_numpy()[rows, cols]
+        if self.float_format is not None:
+            cells = [self.float_format % v if isinstance(v, float) else v for v in cells]
+
+        long_df = pd.DataFrame({
+            "DSCD": df["Type"].to_numpy()[rows],
+            "YEAR": df["YEAR"].to_numpy()[rows],
+            "VARIABLE_ID": self.var_ids[cols],
+            "VALUE": cells,
+        })
+        long_df.to_csv(
+            self.path, mode='a', index=False, header=not os.path.isfile(self.path), encoding='utf-8-sig'
+        )
+        self.cells += len(long_df)
+        self.skipped += mask.size - len(long_df)
+
+class PanelArrayWriter:
+    """
+    每個變數輸出一個 FLOAT_DTYPE 的 .npy，shape = (公司數, 年數)，缺值為 NaN
+    - DSCD.npy（公司軸，即 Type 欄，固定長度 unicode）、YEAR.npy（年度軸）所有變數共用
+    - variables.csv 記錄變數名稱與檔名（檔名中 Windows 不允許的字元換成 _）
+    - 合併時每個國家先 pivot 成 (該國公司數, 該國年數) 區塊寫進暫存檔，
+      全部國家完成、確定公司與年度軸後才組成最終陣列，記憶體只需容納一個國家
+    - 非數值的儲存格存成 NaN，結束時列出各變數略過的個數
+    """
+    def __init__(self, root, columns):
+        self.root = root
+        self.tmp_root = root + ".tmp"
+        self.variables = [c for c in columns if c != "YEAR" and c not in ID_COLUMNS]
+        self.firms = []
+        self.years = set()
+        self.blocks = []        # [(該國公司數, 該國年度)]
+        self.non_numeric = dict.fromkeys(self.variables, 0)
+
+        if os.path.exists(self.tmp_root):
+            shutil.rmtree(self.tmp_root)
+        os.makedirs(self.tmp_root)
+
+    def _raw_path(self, i):
+        return os.path.join(self.tmp_root, f"{i}.raw")
+
+    def append_frame(self, df, name):
+        dup = df.duplicated(["Type", "YEAR"])
+        if dup.any():
+            print(f"  [警告] {name} 有 {int(dup.sum())} 列 Type / YEAR 重複，Panel 陣列只保留第一列")
+            df = df[~dup]
+
+        years = pd.to_numeric(df["YEAR"]).astype(int).to_numpy()
+        firms_c = pd.unique(df["Type"].astype(str))
+        years_c = np.unique(years)
+        rows = pd.Index(firms_c).get_indexer(df["Type"].astype(str))
+        cols = np.searchsorted(years_c, years)
 
-# 檢查資料夾是否存在
-if not os.path.exists(input_path):
-    print(f"[錯誤] 找不到資料夾：{target_folder_name}")
-    print(f"請確認你的目錄結構如下：")
-    print(f"{base_path}\\")
-    print(f"  └── {target_folder_name}\\ (Excel要放在這裡)")
-    input("按 Enter 離開...")
-    sys.exit()
+        for i, var in enumerate(self.variables):
+            col = df[var].astype(object)
+            col = col.where(col.notna() & ~col.isin(MISSING_VALUES), None)
+            values = pd.to_numeric(col, errors="coerce")
+            self.non_numeric[var] += int(values.isna().sum() - col.isna().sum())
 
-all_files = [f for f in glob.glob(os.path.join(input_path, "*.xlsx"))
-             if not os.path.basename(f).startswith("~$")]
+            block = np.full((len(firms_c), len(years_c)), np.nan, dtype=FLOAT_DTYPE)
+            block[rows, cols] = values.to_numpy(dtype=FLOAT_DTYPE)
+            with open(self._raw_path(i), "ab") as f:
+                block.tofile(f)
 
-count = len(all_files)
-print(f"發現 {count} 個 Excel 檔案。")
+        self.firms.extend(firms_c)
+        self.years.update(years_c.tolist())
+        self.blocks.append((len(firms_c), years_c))
+
+    def save(self):
+        years = np.array(sorted(self.years), dtype="int16")
+        np.save(os.path.join(self.tmp_root, "DSCD.npy"), np.array(self.firms, dtype=str))
+        np.save(os.path.join(self.tmp_root, "YEAR.npy"), years)
+
+        files = []
+        for i, var in enumerate(self.variables):
+            fname = re.sub(r'[\\/:*?"<>|]', "_", var) + ".npy"
+            files.append(fname)
+            out = np.lib.format.open_memmap(
+                os.path.join(self.tmp_root, fname), mode="w+", dtype=FLOAT_DTYPE,
+                shape=(len(self.firms), len(years)),
+            )
+            out[:] = np.nan
+            raw_path = self._raw_path(i)
+            # 暫存檔依國家順序逐塊讀（不用 memmap，Windows 上 mapping 還在就無法刪檔）
+            with open(raw_path, "rb") as f:
+                row = 0
+                for n_firms, years_c in self.blocks:
+                    block = np.fromfile(f, dtype=FLOAT_DTYPE, count=n_firms * len(years_c))
+                    out[row:row + n_firms, np.searchsorted(years, years_c)] = block.reshape(n_firms, len(years_c))
+                    row += n_firms
+            out.flush()
+            del out
+            os.remove(raw_path)
+
+            if self.non_numeric[var]:
+                print(f"  [警告] {var} 有 {self.non_numeric[var]} 個非數值，Panel 陣列中為 NaN")
+
+        pd.DataFrame({"VARIABLE": self.variables, "FILE": files}).to_csv(
+            os.path.join(self.tmp_root, "variables.csv"), index=False, encoding='utf-8-sig'
+        )
+        os.replace(self.tmp_root, self.root)
+
+        if len(set(self.firms)) < len(self.firms):
+            print("  [警告] 有 DSCD 出現在多個國家檔，DSCD.npy 中會重複出現")
+        return len(self.firms), len(years)
+
+class SqliteWriter:
+    """
+    每個國家合併完就 append 進 SQLite 的 panel 資料表
+    - 全部載入包在同一個 transaction，每 SQLITE_BATCH 列一次 executemany
+    - 載入完才建索引：(COUNTRY, YEAR)、(Type, YEAR)
+    - 缺值（NaN、"."、"NA"）一律存成 NULL；變數欄宣告 NUMERIC，數字字串會存成數值
+    - 先寫暫存檔，完成後才改名，避免留下寫到一半的資料庫
+    """
+    INDEXES = {
+        "idx_panel_country_year": ["COUNTRY", "YEAR"],
+        "idx_panel_type_year": ["Type", "YEAR"],
+    }
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.columns = list(columns)
+        self.total_rows = 0
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+        self.conn = sqlite3.connect(self.tmp_path, isolation_level=None)
+        # 暫存檔寫壞了重跑即可，不需要 journal
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        self.conn.execute("PRAGMA synchronous = OFF")
+
+        col_defs = []
+        for c in self.columns:
+            if c == "YEAR":
+                affinity = "INTEGER"
+            elif c in ID_COLUMNS:
+                affinity = "TEXT"
+            else:
+                affinity = "NUMERIC"
+            col_defs.append(f"{self._quote(c)} {affinity}")
+        self.conn.execute(f"CREATE TABLE panel ({', '.join(col_defs)})")
+        self.insert_sql = f"INSERT INTO panel VALUES ({', '.join('?' * len(self.columns))})"
+        self.conn.execute("BEGIN")
+
+    @staticmethod
+    def _quote(name):
+        return '"' + name.replace('"', '""') + '"'
+
+    def append_frame(self, df):
+        values = df.astype(object)
+        values = values.where(values.notna() & ~values.isin(MISSING_VALUES), None)
+        rows = values.itertuples(index=False, name=None)
+        while True:
+            batch = list(itertools.islice(rows, SQLITE_BATCH))
+            if not batch:
+                break
+            self.conn.executemany(self.insert_sql, batch)
+            self.total_rows += len(batch)
+
+    def save(self):
+        self.conn.execute("COMMIT")
+        for name, cols in self.INDEXES.items():
+            missing = [c for c in cols if c not in self.columns]
+            if missing:
+                print(f"[警告] 缺少 {', '.join(missing)} 欄，略過索引 {name}")
+                continue
+            self.conn.execute(f"CREATE INDEX {name} ON panel ({', '.join(map(self._quote, cols))})")
+        self.conn.execute("ANALYZE")
+        self.conn.close()
+        os.replace(self.tmp_path, self.path)
+
+def load_pyarrow():
+    """pyarrow 是選用套件，只在要輸出 Parquet 時才 import；沒裝回傳 None"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("[警告] 未安裝 pyarrow，略過 Parquet 輸出（pip install pyarrow）")
+        return None
+    return pa, pq
+
+class ParquetPartitionWriter:
+    """
+    每個國家合併完就寫進 Parquet 資料集，依 COUNTRY / YEAR 分區
+    （all-Ncountries.parquet/COUNTRY=Finland/YEAR=2015/...）
+    - 分析時可只讀需要的國家、年度與欄位，不必整份 CSV 重新 parse
+    - 預設所有欄位一律 string，與 CSV / Excel 的 dtype=str 一致
+    - 型別化輸出時欄位型別以第一個國家為準，之後的國家轉成相同型別
+    """
+    def __init__(self, root, columns, arrow):
+        self.root = root
+        self.pa, self.pq = arrow
+        self.schema = None if TYPED_OUTPUT else self.pa.schema([(c, self.pa.string()) for c in columns])
+
+    def _conform(self, df, name):
+        """型別化輸出：category 轉回字串，與 schema 型別不同的欄位轉成 schema 的型別"""
+        df = df.astype({c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
+        if self.schema is None:
+            self.schema = self.pa.Schema.from_pandas(df, preserve_index=False)
+            return df
+
+        for field in self.schema:
+            col = df[field.name]
+            if self.pa.types.is_floating(field.type) and not pd.api.types.is_float_dtype(col):
+                numeric = pd.to_numeric(col, errors="coerce")
+                lost = int(numeric.isna().sum() - col.isna().sum())
+                if lost:
+                    print(f"  [警告] {name} {field.name} 有 {lost} 個非數值，Parquet 中改為缺值")
+                df[field.name] = numeric.astype(FLOAT_DTYPE)
+            elif self.pa.types.is_string(field.type) and pd.api.types.is_float_dtype(col):
+                df[field.name] = col.map(lambda v: None if pd.isna(v) else f"{v:.15g}")
+        return df
+
+    def append_frame(self, df, name):
+        if TYPED_OUTPUT:
+            values = self._conform(df, name)
+        else:
+            values = df.astype(object).where(df.notna(), None)
+        table = self.pa.Table.from_pandas(values, schema=self.schema, preserve_index=False)
+        self.pq.write_to_dataset(
+            table,
+            root_path=self.root,
+            partition_cols=PARTITION_COLS,
+            basename_template=f"{name}-{{i}}.parquet",  # 檔名帶國家檔名，不會互相覆蓋
+        )
+
+def read_header(filename):
+    """
+    只讀表頭，欄名與 read_country 讀進來的完全相同
+    - 重複欄名由 pandas 改名（X(WC02051)~U$、X(WC02051)~U$.1），空白欄（Unnamed）略過
+    """
+    columns = pd.read_excel(filename, nrows=0).columns
+    return [c for c in columns if not str(c).startswith("Unnamed")]
+
+def column_union(files):
+    """
+    所有國家欄位的聯集，只讀表頭
+    - 依第一個檔案的欄位順序，之後檔案新出現的欄依出現順序接在後面
+    """
+    union = {}
+    for filename in files:
+        try:
+            union.update(dict.fromkeys(read_header(filename)))
+        except Exception as e:
+            # 讀不到表頭的檔案，合併時會再報錯一次
+            print(f"[警告] 無法讀取 {os.path.basename(filename)} 的表頭: {e}")
+    return list(union)
+
+def to_typed(df):
+    """
+    型別化：
+    - YEAR → int16
+    - ID_COLUMNS（COUNTRY、國家代碼、Type/DSCD）→ category
+    - 其他變數欄：全部可轉數值就轉成 FLOAT_DTYPE，有文字的欄維持字串
+    """
+    for col in df.columns:
+        if col == "YEAR":
+            df[col] = pd.to_numeric(df[col]).astype("int16")
+        elif col in ID_COLUMNS:
+            df[col] = df[col].astype("category")
+        else:
+            try:
+                df[col] = pd.to_numeric(df[col]).astype(FLOAT_DTYPE)
+            except (ValueError, TypeError):
+                pass    # 文字變數（公司名稱等），維持字串
+    return df
+
+def read_country(filename):
+    """
+    讀單一國家檔案，回傳 (DataFrame, 錯誤訊息)
+    - process pool 用：例外轉成訊息回傳，由主程序依檔案順序印出
+    """
+    try:
+        if TYPED_OUTPUT:
+            df = pd.read_excel(
+                filename,
+                dtype={c: str for c in ID_COLUMNS},
+                na_values=MISSING_VALUES,
+                keep_default_na=False,
+            )
+        else:
+            df = pd.read_excel(filename, dtype=str)
+        df = df.loc[:, ~df.columns.str.contains('^Unnamed')]  # 去掉多餘的空白欄
+        if TYPED_OUTPUT:
+            df = to_typed(df)
+        return df, None
+    except Exception as e:
+        return None, str(e)
+
+def iter_country_frames(files):
+    """
+    依檔案順序回傳 (檔名, DataFrame, 錯誤訊息)；WORKERS > 1 時背景平行讀取
+    - 最多只預讀 WORKERS + 1 個檔案，主程序還在寫輸出時不會把所有國家都堆在記憶體裡
+    """
+    if WORKERS > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+            pending = deque()
+            remaining = iter(files)
+            for filename in itertools.islice(remaining, WORKERS + 1):
+                pending.append((filename, executor.submit(read_country, filename)))
+            while pending:
+                filename, future = pending.popleft()
+                df, error = future.result()
+                for next_file in itertools.islice(remaining, 1):
+                    pending.append((next_file, executor.submit(read_country, next_file)))
+                yield filename, df, error
+    else:
+        for filename in files:
+            df, error = read_country(filename)
+            yield filename, df, error
+
+def main():
+    print(f"程式位置: {base_path}")
+    print(f"正在搜尋資料夾: {input_path}")
+    print("-" * 30)
+
+    # 檢查資料夾是否存在
+    if not os.path.exists(input_path):
+        print(f"[錯誤] 找不到資料夾：{target_folder_name}")
+        print(f"請確認你的目錄結構如下：")
+        print(f"{base_path}\\")
+        print(f"  └── {target_folder_name}\\ (Excel要放在這裡)")
+        input("按 Enter 離開...")
+        sys.exit()
+
+    all_files = [f for f in glob.glob(os.path.join(input_path, "*.xlsx"))
+                 if not os.path.basename(f).startswith("~$")]
+
+    count = len(all_files)
+    print(f"發現 {count} 個 Excel 檔案。")
+
+    if count == 0:
+        print("沒有新檔案需要合併。")
+        return
 
-if count > 0:
     final_excel_name = f"all-{count}countries.xlsx"
     final_csv_name   = f"all-{count}countries.csv"
     log_file_name    = f"all-{count}countries_integrate_log.txt"
+    parquet_name     = f"all-{count}countries.parquet"
+    index_name       = f"all-{count}countries.index.json"
+    sqlite_name      = f"all-{count}countries.sqlite"
+    long_name        = f"all-{count}countries-long.csv"
+    variables_name   = f"all-{count}countries-variables.csv"
+    panel_name       = f"all-{count}countries-panel"
 
-    output_excel_path = os.path.join(base_path, final_excel_name)
-    output_csv_path   = os.path.join(base_path, final_csv_name)
-    log_path          = os.path.join(base_path, log_file_name)
+    output_excel_path   = os.path.join(base_path, final_excel_name)
+    output_csv_path     = os.path.join(base_path, final_csv_name)
+    log_path            = os.path.join(base_path, log_file_name)
+    output_parquet_path = os.path.join(base_path, parquet_name)
+    output_index_path   = os.path.join(base_path, index_name)
+    output_sqlite_path  = os.path.join(base_path, sqlite_name)
+    output_long_path    = os.path.join(base_path, long_name)
+    variables_path      = os.path.join(base_path, variables_name)
+    output_panel_path   = os.path.join(base_path, panel_name)
 
     final_files = [
         output_excel_path,
         output_csv_path,
-        log_path
+        log_path,
+        output_parquet_path,
+        output_index_path,
+        output_sqlite_path,
+        output_long_path,
+        variables_path,
+        output_panel_path
     ]
 
     existing_files = [f for f in final_files if os.path.exists(f)]
@@ -67,62 +572,159 @@ if count > 0:
         else:
             for f in existing_files:
                 try:
-                    os.remove(f)
+                    if os.path.isdir(f):
+                        shutil.rmtree(f)   # Parquet 資料集是資料夾
+                    else:
+                        os.remove(f)
                     print(f"已刪除舊檔：{os.path.basename(f)}")
                 except Exception as e:
                     print(f"[錯誤] 無法刪除 {f}: {e}")
-    
+
+    # 先問要不要 Excel，合併的同時直接串流寫出，不必事後重讀整份 CSV
+    excel_writer = None
+    user_input = input(f"是否要同時輸出 Excel（{final_excel_name}）？(y/n): ").strip().lower()
+    if user_input == "y":
+        excel_writer = ExcelShardWriter(output_excel_path)
+    else:
+        print("跳過 Excel，只輸出 CSV 檔案。")
+
     # 讀取「已完成清單」
     processed_files = set()
     if os.path.exists(log_path):
         with open(log_path, "r", encoding="utf-8") as f:
             processed_files = set(line.strip() for line in f)
 
+    # === 過濾區 ===
+    pending_files = [f for f in all_files if os.path.basename(f) not in processed_files]
+    # =============
+
+    # 先只讀表頭算出所有國家的欄位聯集，各國依聯集對齊，缺的欄補空白
+    columns = column_union(pending_files)
+    print(f"欄位聯集: {len(columns)} 欄")
+
+    csv_writer = IndexedCsvWriter(output_csv_path, output_index_path)
+
+    parquet_writer = None
+    if PARQUET_OUTPUT:
+        missing_partition = [c for c in PARTITION_COLS if c not in columns]
+        if missing_partition:
+            print(f"[警告] 缺少分區欄位 {', '.join(missing_partition)}，略過 Parquet 輸出")
+        else:
+            arrow = load_pyarrow()
+            if arrow is not None:
+                parquet_writer = ParquetPartitionWriter(output_parquet_path, columns, arrow)
+
+    sqlite_writer = SqliteWriter(output_sqlite_path, columns) if SQLITE_OUTPUT else None
+
+    long_writer = None
+    if LONG_OUTPUT:
+        missing_keys = [c for c in ["Type", "YEAR"] if c not in columns]
+        if missing_keys:
+            print(f"[警告] 缺少 {', '.join(missing_keys)} 欄，略過長表輸出")
+        else:
+            long_writer = LongCsvWriter(output_long_path, variables_path, columns)
+
+    panel_writer = None
+    if PANEL_ARRAYS:
+        missing_keys = [c for c in ["Type", "YEAR"] if c not in columns]
+        if missing_keys:
+            print(f"[警告] 缺少 {', '.join(missing_keys)} 欄，略過 Panel 陣列輸出")
+        else:
+            panel_writer = PanelArrayWriter(output_panel_path, columns)
+
     actual_merge_count = 0
-    for filename in all_files:
+    for filename, df, error in iter_country_frames(pending_files):
         file_basename = os.path.basename(filename)
-        
-        # === 過濾區 ===
-        if file_basename in processed_files:
+
+        if error is not None:
+            print(f"[錯誤] 讀取 {file_basename} 失敗: {error}")
             continue
-        # =============
-        
-        try:
-            df = pd.read_excel(filename, dtype=str)
-            df = df.loc[:, ~df.columns.str.contains('^Unnamed')]  # 去掉多餘的空白欄
 
+        try:
             print(f"正在合併: {file_basename} ({len(df.columns)} 欄)")
-            
-            # 寫入 CSV (存放在外面那一層，避免汙染資料夾)
-            file_exists = os.path.isfile(output_csv_path)
-            df.to_csv(output_csv_path, mode='a', index=False, header=not file_exists, encoding='utf-8-sig')
-            
+
+            missing = [c for c in columns if c not in df.columns]
+            if missing:
+                print(f"  ↳ 缺少 {len(missing)} 欄，以空白補齊: {', '.join(map(str, missing))}")
+            dropped = [c for c in df.columns if c not in columns]
+            if dropped:
+                print(f"  [警告] {len(dropped)} 欄不在欄位聯集中，不會寫入: {', '.join(map(str, dropped))}")
+            df = df.reindex(columns=columns)
+
+            # 寫入 CSV (存放在外面那一層，避免汙染資料夾)，並記錄各國 / 各年度的 byte 位置
+            csv_writer.append_frame(df, file_basename)
+
+            # 同一份資料同時串流進 Excel
+            if excel_writer is not None:
+                excel_writer.append_frame(df)
+
+            # 依 COUNTRY / YEAR 分區寫進 Parquet 資料集
+            if parquet_writer is not None:
+                parquet_writer.append_frame(df, os.path.splitext(file_basename)[0])
+
+            if sqlite_writer is not None:
+                sqlite_writer.append_frame(df)
+
+            if long_writer is not None:
+                long_writer.append_frame(df)
+
+            if panel_writer is not None:
+                panel_writer.append_frame(df, file_basename)
+
             # 寫入 Log
             with open(log_path, "a", encoding="utf-8") as f:
                 f.write(file_basename + "\n")
-                
+
             actual_merge_count += 1
-            
+
         except Exception as e:
             print(f"[錯誤] 讀取 {file_basename} 失敗: {e}")
 
     print("-" * 30)
     print(f"本次新增合併 {actual_merge_count} 個檔案。")
 
-# ================= 轉存 Excel =================
-if os.path.exists(output_csv_path):
-    print(f"即將建立最終檔案: {final_excel_name}，可能會花幾分鐘...")
-    
-    user_input = input("是否要轉存為 Excel？(y/n): ").strip().lower()
-    if user_input == "y":
+    # ================= 輸出 Excel =================
+    if excel_writer is not None:
         try:
-            df_final = pd.read_csv(output_csv_path, dtype=str)  # 指定型態為字串，避免 DtypeWarning
-            df_final.to_excel(output_excel_path, index=False)
-            print(f"\n★ 成功！檔案位置: {output_excel_path}")
+            n_sheets = excel_writer.save()
+            print(
+                f"\n★ 成功！檔案位置: {output_excel_path}"
+                f"（{excel_writer.total_rows} 列，{n_sheets} 張工作表）"
+            )
         except Exception as e:
-            print(f"轉存 Excel 失敗: {e}")
-    else:
-        print("跳過轉存 Excel，只輸出 CSV 檔案。")
-else:
-    if count == 0:
-        print("沒有新檔案需要合併。")
+            print(f"輸出 Excel 失敗: {e}")
+
+    if os.path.exists(output_index_path):
+        print(f"★ CSV 區塊索引（csv-extract.py 用）: {output_index_path}")
+
+    if parquet_writer is not None:
+        print(f"★ Parquet 資料集（依 {' / '.join(PARTITION_COLS)} 分區）: {output_parquet_path}")
+
+    if long_writer is not None:
+        total = long_writer.cells + long_writer.skipped
+        print(
+            f"★ 長表: {output_long_path}（{long_writer.cells} 筆，略過 {long_writer.skipped} 個缺值"
+            f"，缺值率 {long_writer.skipped / total:.1%}）" if total else f"★ 長表: {output_long_path}（0 筆）"
+        )
+        print(f"★ 變數對照表: {variables_path}")
+
+    if panel_writer is not None:
+        try:
+            n_firms, n_years = panel_writer.save()
+            print(
+                f"★ Panel 陣列: {output_panel_path}"
+                f"（{n_firms} 家公司 × {n_years} 年，{len(panel_writer.variables)} 個變數）"
+            )
+        except Exception as e:
+            print(f"輸出 Panel 陣列失敗: {e}")
+
+    if sqlite_writer is not None:
+        try:
+            sqlite_writer.save()
+            print(f"★ SQLite 資料庫: {output_sqlite_path}（{sqlite_writer.total_rows} 列，資料表 panel）")
+        except Exception as e:
+            print(f"輸出 SQLite 失敗: {e}")
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()   # 打包成 exe 時 process pool 需要
+    main()
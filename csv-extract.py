@@ -0,0 +1,95 @@
+import glob
+import json
+import mmap
+import os
+import re
+
+# ========= 用 country-integrate.py 產生的 all-Ncountries.index.json，直接切出指定國家 / 年度 =========
+# 只 seek 到索引記錄的 byte 區塊，不必 parse 整份 CSV
+index_files = glob.glob("all-*countries.index.json")
+if not index_files:
+    print("找不到 all-*countries.index.json，請先執行 country-integrate.py")
+    exit()
+
+# ========= 如果找到多個索引，列出給使用者選 =========
+if len(index_files) > 1:
+    print("找到多個符合條件的索引檔案：")
+    for i, f in enumerate(index_files, 1):
+        print(f"{i}. {f}")
+    while True:
+        choice = input(f"請輸入要處理的檔案的國家數量: ").strip()
+        matched_files = [f for f in index_files if re.search(rf"all-{choice}countries\.index\.json", f)]
+        if matched_files:
+            index_file = matched_files[0]
+            break
+        print("找不到符合條件的檔案，請重新輸入")
+else:
+    index_file = index_files[0]
+
+with open(index_file, "r", encoding="utf-8") as f:
+    index = json.load(f)
+
+csv_file = os.path.join(os.path.dirname(index_file), index["csv"])
+print(f"你選擇的檔案是: {csv_file}")
+
+# ========= 確認 CSV 與索引一致（CSV 被改過，位置就不對了）=========
+blocks_end = max(
+    [sum(index["header"])] + [e["offset"] + e["length"] for entries in index["countries"].values() for e in entries]
+)
+if not os.path.exists(csv_file) or os.path.getsize(csv_file) != blocks_end:
+    print(f"[錯誤] {index['csv']} 與索引不一致，請重新執行 country-integrate.py")
+    exit()
+
+# ========= 選國家 / 年度 =========
+print("索引中的國家：")
+for country, entries in index["countries"].items():
+    years = sorted({y for e in entries for y in e["years"]})
+    span = f"{years[0]}-{years[-1]}" if years else "-"
+    print(f" - {country}（{sum(e['rows'] for e in entries)} 列，{span}）")
+
+while True:
+    countries = [c.strip() for c in input("請輸入國家（多個以逗號分隔）: ").split(",") if c.strip()]
+    unknown = [c for c in countries if c not in index["countries"]]
+    if countries and not unknown:
+        break
+    print(f"找不到國家：{', '.join(unknown)}，請重新輸入" if unknown else "請至少輸入一個國家")
+
+years = [y.strip() for y in input("請輸入年度（多個以逗號分隔，留空 = 全部）: ").split(",") if y.strip()]
+
+# ========= 收集要讀的區塊 =========
+blocks = []  # [offset, length, rows]
+for country in countries:
+    for entry in index["countries"][country]:
+        if not years:
+            blocks.append([entry["offset"], entry["length"], entry["rows"]])
+            continue
+        for year in years:
+            blocks.extend(entry["years"].get(year, []))
+blocks.sort()
+
+if not blocks:
+    print("指定的國家 / 年度沒有資料")
+    exit()
+
+suffix = "-".join(countries) + (f"-{'-'.join(years)}" if years else "")
+output_file = f"extract-{suffix}.csv"
+
+# ========= 檢查檔案是否存在 =========
+if os.path.exists(output_file):
+    ans = input(f"檔案 '{output_file}' 已存在，是否刪除並生成新檔？(y/n): ").strip().lower()
+    if ans != 'y':
+        print("取消操作，程式結束。")
+        exit()
+    else:
+        os.remove(output_file)
+        print(f"已刪除舊檔 '{output_file}'。")
+
+# ========= memory-map CSV，表頭 + 各區塊原封不動寫出 =========
+header_offset, header_length = index["header"]
+with open(csv_file, "rb") as src, mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+        open(output_file, "wb") as out:
+    out.write(mm[header_offset:header_offset + header_length])
+    for offset, length, _ in blocks:
+        out.write(mm[offset:offset + length])
+
+print(f"已輸出 {sum(b[2] for b in blocks)} 列（{len(blocks)} 個區塊）到 '{output_file}'")
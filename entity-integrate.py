@@ -1,13 +1,27 @@
 import re
 import os
 import sys
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from openpyxl import load_workbook
+from functools import partial
+from itertools import chain
+import numpy as np
+from openpyxl import Workbook, load_workbook
+from year_window import START_YEAR, END_YEAR    # 年度區間，三支整合程式共用
+from integrate_common import SheetBuffer, run_buffered
 
 # ================== 設定 ==================
 INPUT_FOLDER = "data-split-by-entity"
 OUTPUT_FOLDER = "data-split-by-variable"
 REQUEST_SHEET = "REQUEST_TABLE"
+STREAMING_MERGE = True  # True：read-only 逐列讀、write-only 逐列寫（省記憶體，不保留格式）；False：整本載入後合併
+WORKERS = 1             # >1 時以 process pool 平行處理各 (國家, 年段, 變數組) 群組
+PRECHECK = True         # 合併前先比對整組所有檔案的 REQUEST_TABLE，有問題就整組略過不輸出
+DUPLICATE_DSCD = "report"  # 跨公司群重複的 Type（DSCD）："report" 只回報、"drop" 剔除後回報、None 不檢查
+PREFETCH_DEPTH = 2      # 整本載入模式（STREAMING_MERGE = False）背景預讀的公司群數上限（0 = 不預讀）；越大越吃記憶體
 LOG_FILE = f"entity_integrate_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
@@ -42,7 +56,7 @@ def parse_filename(fname):
     m = pattern.fullmatch(name)
     return m.groupdict() if m else None
 
-def check_request_table(wb, fname, company_no, start, end):
+def check_request_table(wb, fname, company_no, start, end, log=print):
     ws = wb[REQUEST_SHEET]
     expected_series = f"FDEALL{company_no}"
 
@@ -56,7 +70,7 @@ def check_request_table(wb, fname, company_no, start, end):
     while ws[f"E{row}"].value not in (None, ""):
         # ===== E 欄：公司組數檢查 =====
         if ws[f"E{row}"].value != expected_series:
-            print(
+            log(
                 f"⚠️ 跳過: {fname} REQUEST_TABLE E{row} = {ws[f'E{row}'].value}，"
                 f"預期 {expected_series}"
             )
@@ -64,7 +78,7 @@ def check_request_table(wb, fname, company_no, start, end):
 
         # ===== G 欄：年份檢查 =====
         if year_idx >= len(expected_years):
-            print(
+            log(
                 f"⚠️ 跳過: {fname} REQUEST_TABLE 年份列數超出檔名範圍（從 G{row} 開始）"
             )
             return False
@@ -75,14 +89,14 @@ def check_request_table(wb, fname, company_no, start, end):
         try:
             cell_year = int(str(raw_year).strip())
         except Exception:
-            print(
+            log(
                 f"⚠️ 跳過: {fname} REQUEST_TABLE G{row} = {raw_year}，"
                 f"無法解析為年份"
             )
             return False
 
         if cell_year != expected_year:
-            print(
+            log(
                 f"⚠️ 跳過: {fname} REQUEST_TABLE G{row} = {cell_year}，"
                 f"預期 {expected_year}（與檔名年份不一致）"
             )
@@ -113,13 +127,17 @@ def get_request_table_value(ws, col, start_row=7):
         row += 1
     return values
 
-def validate_wb(wb, fname, company_no, start, end, years):
+def window_year_indices(start, years):
+    """年段內落在 START_YEAR ~ END_YEAR 的 year_idx（第 year_idx 張工作表 = start + year_idx 年）"""
+    return [i for i in range(years) if START_YEAR <= int(start) + i <= END_YEAR]
+
+def validate_wb(wb, fname, company_no, start, end, years, log=print):
     # ===== 確定 REQUEST_TABLE 存在 =====
     if REQUEST_SHEET not in wb.sheetnames:
         raise ValueError(f"{fname} 缺少 REQUEST_TABLE")
     
     # ===== 檢查 檔名和 REQUEST_TABLE 的 Series 一致 =====
-    check_request_table(wb, fname, company_no, start, end)
+    check_request_table(wb, fname, company_no, start, end, log=log)
     
     # ===== 檢查 檔名和 工作表數量 一致 =====
     data_sheets = [s for s in wb.sheetnames if s != REQUEST_SHEET]
@@ -128,58 +146,286 @@ def validate_wb(wb, fname, company_no, start, end, years):
             f"{fname} 工作表數量不足，預期 {years} 張，實際 {len(data_sheets)}"
         )
 
-def print_sheet_shapes(wb, fname, skip_sheet=REQUEST_SHEET):
+# ================== 合併前預檢 ==================
+def read_request_columns(fname):
     """
-    印出 workbook 每個 sheet 的 shape
-    - wb: Workbook 物件
-    - title: log 標題
-    - skip_sheet: 不印的 sheet 名稱（預設 REQUEST_TABLE）
+    只讀 REQUEST_TABLE 的 E/G/N/O 欄（從第 7 列開始，E 欄空白就停）
+    回傳 list[(E, G, N, O)]；不解析任何資料工作表
     """
-    for ws_name in wb.sheetnames:
-        if ws_name == skip_sheet:
-            continue
-        ws = wb[ws_name]
-        rows = actual_rows(ws)
-        cols = actual_cols(ws)
-        print(f"{fname} 🔹 工作表: {ws_name}, "
-              f"shape: {rows} rows x {cols} columns")
+    wb = load_workbook(fname, read_only=True, data_only=True)
+    try:
+        if REQUEST_SHEET not in wb.sheetnames:
+            raise ValueError(f"{fname} 缺少 REQUEST_TABLE")
+        entries = []
+        for row in wb[REQUEST_SHEET].iter_rows(min_row=7, min_col=5, max_col=15, values_only=True):
+            if row[0] in (None, ""):
+                break
+            entries.append((row[0], row[2], row[9], row[10]))
+        return entries
+    finally:
+        wb.close()
 
-def actual_rows(ws):
+def to_number(value):
+    try:
+        return float(str(value).strip())
+    except (TypeError, ValueError):
+        return np.nan
+
+def precheck_group(companies, start, years):
     """
-    計算實際有資料的 row 數（忽略尾端空白列）
+    合併前一次檢查整組所有公司群的 REQUEST_TABLE：
+    - E 欄：FDEALL{company}
+    - G 欄：年份序列與檔名一致
+    - N 欄：至少有 header 一列
+    - O 欄：是數字，且每一年的欄位數都與 company 1 相同（company 1 該年無法比對時只回報 company 1）
+    各欄疊成 (公司群數 x 年數) 的陣列後一次比對；回傳問題清單（空 list 代表通過）
     """
-    last = 0
-    for i, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=1):
-        if any(cell is not None for cell in row):
-            last = i
-    return last
+    order = sorted(companies)
+    n = len(order)
+
+    series = np.full((n, years), None, dtype=object)
+    raw_years = np.full((n, years), None, dtype=object)
+    year_arr = np.full((n, years), np.nan)
+    rows_arr = np.full((n, years), np.nan)
+    cols_arr = np.full((n, years), np.nan)
+    raw_cols = np.full((n, years), None, dtype=object)
+    row_counts = np.zeros(n, dtype=int)
+
+    for i, company in enumerate(order):
+        entries = read_request_columns(os.path.join(INPUT_FOLDER, companies[company]))
+        row_counts[i] = len(entries)
+        for j, (e, g, n_val, o_val) in enumerate(entries[:years]):
+            series[i, j] = e
+            raw_years[i, j] = g
+            year_arr[i, j] = to_number(g)
+            rows_arr[i, j] = to_number(n_val)
+            cols_arr[i, j] = to_number(o_val)
+            raw_cols[i, j] = o_val
+
+    expected_series = np.array([f"FDEALL{c}" for c in order], dtype=object)[:, None]
+    expected_years = np.arange(int(start), int(start) + years)[None, :]
+    present = np.arange(years)[None, :] < row_counts[:, None]
+
+    bad_series = (series != expected_series) & present
+    bad_years = (year_arr != expected_years) & present      # NaN 也算不一致
+    bad_rows = ~(rows_arr >= 1) & present
+    cols_nan = np.isnan(cols_arr)
+    bad_cols_value = cols_nan & present
+    bad_cols = (cols_arr != cols_arr[0]) & ~cols_nan & ~cols_nan[0] & present
+
+    problems = []
+    for i in np.nonzero(row_counts != years)[0]:
+        problems.append(
+            f"{companies[order[i]]} REQUEST_TABLE 年份列數 {row_counts[i]}，預期 {years}"
+        )
+    for i, j in zip(*np.nonzero(bad_series)):
+        problems.append(
+            f"{companies[order[i]]} REQUEST_TABLE E{7+j} = {series[i, j]}，預期 {expected_series[i, 0]}"
+        )
+    for i, j in zip(*np.nonzero(bad_years)):
+        problems.append(
+            f"{companies[order[i]]} REQUEST_TABLE G{7+j} = {raw_years[i, j]}，預期 {expected_years[0, j]}"
+        )
+    for i, j in zip(*np.nonzero(bad_rows)):
+        problems.append(
+            f"{companies[order[i]]} REQUEST_TABLE N{7+j} = {rows_arr[i, j]:g}，無法作為列數"
+        )
+    for i, j in zip(*np.nonzero(bad_cols_value)):
+        problems.append(
+            f"{companies[order[i]]} REQUEST_TABLE O{7+j} = {raw_cols[i, j]}，無法作為欄數"
+        )
+    for i, j in zip(*np.nonzero(bad_cols)):
+        problems.append(
+            f"❌ COLS 不一致 | {companies[order[0]]} O{7+j}={cols_arr[0, j]:g} | "
+            f"{companies[order[i]]} O{7+j}={cols_arr[i, j]:g}"
+        )
+    return problems
 
-def actual_cols(ws):
+# ================== 背景預讀 ==================
+def load_company(companies, company, start, end, years, window_sheets):
     """
-    計算實際有資料的欄位數（忽略尾端空欄）
+    讀取並檢查單一公司群：window_sheets 的資料列直接讀進 SheetBuffer，讀完就關檔
+    - read-only workbook 是 lazy 載入，真正耗時的是逐列 parse，所以要在這裡就讀完
+    回傳 ({工作表: SheetBuffer}, REQUEST_TABLE N 欄, O 欄, 檢查訊息)；訊息留給主執行緒依序印出
     """
-    max_cols = 0
-    for row in ws.iter_rows(min_row=2, values_only=True):
-        if not row:
+    messages = []
+    fname = os.path.join(INPUT_FOLDER, companies[company])
+    wb = load_workbook(fname, read_only=True, data_only=True)
+    try:
+        validate_wb(wb, fname, company, start, end, years, log=messages.append)
+        rows_by_year = get_request_table_value(wb[REQUEST_SHEET], "N")
+        cols_by_year = get_request_table_value(wb[REQUEST_SHEET], "O")
+        buffers = {
+            ws_name: SheetBuffer.from_sheet(
+                wb[ws_name],
+                rows_by_year[year_idx] if year_idx < len(rows_by_year) else 0,
+                cols_by_year[year_idx] if year_idx < len(cols_by_year) else 0,
+            )
+            for year_idx, ws_name in window_sheets
+        }
+    finally:
+        wb.close()
+    return buffers, rows_by_year, cols_by_year, messages
+
+def prefetch_companies(companies, start, end, years, window_sheets):
+    """
+    整本載入模式用：依序產生 company 2..N 的 (company, fname_only, {工作表: SheetBuffer}, N 欄, O 欄)
+    - 背景執行緒先讀 / 檢查後面的公司群，主執行緒同時 append 目前這一個
+    - 佇列最多放 PREFETCH_DEPTH 個公司群，用來控制記憶體上限
+    - 載入失敗的例外在輪到該公司群時才拋出，與逐一載入時的 log 順序相同
+    - 串流模式不預讀：預讀得把資料列留在記憶體，違背串流逐列寫出的用意
+    """
+    others = [c for c in sorted(companies) if c != 1]
+
+    if PREFETCH_DEPTH < 1:
+        for company in others:
+            buffers, rows_by_year, cols_by_year, messages = load_company(
+                companies, company, start, end, years, window_sheets
+            )
+            for msg in messages:
+                print(msg)
+            yield company, companies[company], buffers, rows_by_year, cols_by_year
+        return
+
+    loaded = queue.Queue(maxsize=PREFETCH_DEPTH)
+    stop = threading.Event()
+
+    def worker():
+        for company in others:
+            try:
+                item = (company, load_company(companies, company, start, end, years, window_sheets))
+            except Exception as e:
+                item = (company, e)
+            # 主執行緒中途放棄時（例外），不要卡在 put
+            while not stop.is_set():
+                try:
+                    loaded.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set() or isinstance(item[1], Exception):
+                return
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    try:
+        for _ in others:
+            company, result = loaded.get()
+            if isinstance(result, Exception):
+                raise result
+            buffers, rows_by_year, cols_by_year, messages = result
+            for msg in messages:
+                print(msg)
+            yield company, companies[company], buffers, rows_by_year, cols_by_year
+    finally:
+        stop.set()
+
+def open_companies(companies, start, end, years):
+    """
+    串流模式用：依序以 read-only 開啟 company 2..N，產生 (company, fname_only, workbook, N 欄, O 欄)
+    - 工作表留給呼叫端逐列 iterate，用完由呼叫端關檔
+    """
+    for company in sorted(companies):
+        if company == 1:
             continue
+        fname = os.path.join(INPUT_FOLDER, companies[company])
+        wb = load_workbook(fname, read_only=True, data_only=True)
+        validate_wb(wb, fname, company, start, end, years)
+        yield (
+            company, companies[company], wb,
+            get_request_table_value(wb[REQUEST_SHEET], "N"),
+            get_request_table_value(wb[REQUEST_SHEET], "O"),
+        )
+
+class SheetShape:
+    """
+    工作表實際有資料的 shape（不含 header）
+    - rows：最後一個非空白列的位置（忽略尾端空白列）
+    - cols：最後一個非 None 欄位的位置（忽略尾端空欄）
+    建立時掃描一次，之後每 append 一列就用 add_row 遞增更新，不必重掃整張表
+    """
+    def __init__(self, ws=None):
+        self.rows = 0
+        self.cols = 0
+        self._blank_tail = 0    # 尾端連續空白列，之後出現非空白列才計入 rows
+        if ws is not None:
+            for row in ws.iter_rows(min_row=2, values_only=True):
+                self.add_row(row)
+
+    def add_row(self, row):
         # 找最後一個非 None 的 index
         for i in range(len(row), 0, -1):
             if row[i-1] is not None:
-                max_cols = max(max_cols, i)
-                break
-    return max_cols
+                self.rows += self._blank_tail + 1
+                self._blank_tail = 0
+                self.cols = max(self.cols, i)
+                return
+        self._blank_tail += 1
+
+def print_sheet_shapes(shapes, fname):
+    """
+    印出每個 sheet 的 shape
+    - shapes: {sheet 名稱: SheetShape}（不含 REQUEST_TABLE）
+    - fname: log 標題
+    """
+    for ws_name, shape in shapes.items():
+        print(f"{fname} 🔹 工作表: {ws_name}, "
+              f"shape: {shape.rows} rows x {shape.cols} columns")
+
+class DscdIndex:
+    """
+    每張年度工作表一個 Type（DSCD）hash set，合併時逐列 O(1) 檢查
+    是否已出現在前面的公司群（同一公司群內的重複不算）
+    """
+    def __init__(self, mode):
+        self.mode = mode
+        self.seen = defaultdict(set)      # 前面公司群的 Type
+        self.current = defaultdict(set)   # 目前公司群的 Type
+        self.duplicates = defaultdict(list)
+
+    def keep(self, ws_name, row):
+        """登記 row 的 Type；重複且 mode 為 "drop" 時回傳 False"""
+        if self.mode is None or row[0] is None:
+            return True
+        dscd = str(row[0]).strip()
+        if dscd in self.seen[ws_name]:
+            self.duplicates[ws_name].append(dscd)
+            return self.mode != "drop"
+        self.current[ws_name].add(dscd)
+        return True
+
+    def register_sheet(self, ws_name, ws):
+        """已在工作表裡的列（in-place 模式的 company 1）只登記不檢查"""
+        for row in ws.iter_rows(min_row=2, max_col=1, values_only=True):
+            self.keep(ws_name, row)
+
+    def end_company(self, fname_only):
+        """目前公司群結束：印出重複統計，並把 Type 併入已出現集合"""
+        if self.mode is not None:
+            total = sum(len(v) for v in self.duplicates.values())
+            if total:
+                action = "已剔除" if self.mode == "drop" else "僅回報，仍保留"
+                detail = ", ".join(f"{k}: {len(v)}" for k, v in self.duplicates.items())
+                sample = next(iter(self.duplicates.values()))[:5]
+                print(
+                    f"🔁 {fname_only} 重複 DSCD {total} 筆（{detail}）→ {action}，"
+                    f"例：{', '.join(sample)}"
+                )
+        for ws_name, types in self.current.items():
+            self.seen[ws_name] |= types
+        self.current.clear()
+        self.duplicates.clear()
 
 # ================== row append ==================
-def append_sheet_rows(target_ws, source_ws, fname_only, base_cols_by_year, src_cols_by_year, year_idx):
+def append_sheet_rows(target_ws, source_buf, ws_name, target_shape, fname_only, base_cols_by_year, src_cols_by_year, year_idx, dscd_index):
     """
-    將 source_ws 的資料接到 target_ws 後面
+    將 source_buf 的資料接到 target_ws 後面
     - 只允許欄位數一致
     - 不一致時印出警告，但仍跳過 append
+    - append 的同時更新 target_shape
+    - 重複的 Type 交給 dscd_index 判斷是否剔除
     """
-    target_cols = actual_cols(target_ws)
-    source_cols = actual_cols(source_ws)
-
-    if target_cols != source_cols:
+    if target_shape.cols != source_buf.cols:
         print(
             f"❌ COLS 不一致 | "
             f"{os.path.basename(target_ws.parent.properties.title)} "
@@ -188,12 +434,258 @@ def append_sheet_rows(target_ws, source_ws, fname_only, base_cols_by_year, src_c
         )
         return False  # 不 append
 
+    for row in source_buf.data():
+        row = row.tolist()
+        if not dscd_index.keep(ws_name, row):
+            continue
+        target_ws.append(row)
+        target_shape.add_row(row)
+    
+    return True
+
+def write_request_table_shapes(shapes, out_name, set_cells):
+    """
+    依合併後的 shape 回寫 REQUEST_TABLE N/O/P 欄
+    - set_cells(excel_row, rows, cols, total) 負責實際寫入
+    """
+    for i, shape in enumerate(shapes.values()):
+        rows = shape.rows + 1       # +1 算 header
+        cols = shape.cols
+        total = rows * cols
+
+        set_cells(7 + i, rows, cols, total)
+
+        print(
+            f"🧮 {out_name} REQUEST_TABLE row {7+i}: "
+            f"N={rows}, O={cols}, P={total}"
+        )
+
+def merge_group_inplace(companies, start, end, years, year_idxs, out_name, out_path):
+    """
+    整本載入合併（保留 company 1 的格式）：
+    - company 1 作為模板，其他公司群的 rows 以 append 接在各年度工作表後面
+    - 其他公司群以 read-only 讀進依 N x O 預先配置的 SheetBuffer，不建立 cell 物件；
+      讀取在背景執行緒預先進行（PREFETCH_DEPTH）
+    - 只合併 year_idxs 的工作表；區間外的工作表與 REQUEST_TABLE 列從模板刪掉
+    """
+    base_company = 1
+    base_file = os.path.join(INPUT_FOLDER, companies[1])
+
+    wb_base = load_workbook(base_file, data_only=True)
+
+    validate_wb(wb_base, base_file, base_company, start, end, years)
+
+    ws_req_base = wb_base[REQUEST_SHEET]
+    base_cols_by_year = get_request_table_value(ws_req_base, "O")
+
+    all_sheets = [s for s in wb_base.sheetnames if s != REQUEST_SHEET]
+    window_sheets = [(i, all_sheets[i]) for i in year_idxs if i < len(all_sheets)]
+
+    # ===== 區間外年度：模板直接刪表、刪 REQUEST_TABLE 列（由下往上刪，列號才不會跑掉）=====
+    for year_idx in reversed(range(len(all_sheets))):
+        if year_idx not in year_idxs:
+            del wb_base[all_sheets[year_idx]]
+            ws_req_base.delete_rows(7 + year_idx)
+
+    # ===== 每張工作表只掃描一次，之後隨 append 更新 =====
+    data_sheets = [ws_name for _, ws_name in window_sheets]
+    merged_shapes = {ws_name: SheetShape(wb_base[ws_name]) for ws_name in data_sheets}
+    print_sheet_shapes(merged_shapes, companies[1])
+
+    dscd_index = DscdIndex(DUPLICATE_DSCD)
+    if DUPLICATE_DSCD is not None:
+        for ws_name in data_sheets:
+            dscd_index.register_sheet(ws_name, wb_base[ws_name])
+        dscd_index.end_company(companies[1])
+
+    for company, fname_only, src_bufs, src_rows_by_year, src_cols_by_year in prefetch_companies(
+        companies, start, end, years, window_sheets
+    ):
+        for year_idx, ws_name in window_sheets:
+            ws_base = wb_base[ws_name]
+            src_buf = src_bufs[ws_name]
+
+            print(
+                f"{fname_only} 🔹 工作表: {ws_name}, "
+                f"shape: {src_buf.rows} rows x {src_buf.cols} columns"
+            )
+
+            append_sheet_rows(ws_base, src_buf, ws_name, merged_shapes[ws_name], fname_only, base_cols_by_year, src_cols_by_year, year_idx, dscd_index)
+
+        dscd_index.end_company(fname_only)
+
+    print(f"\n📊 {out_name} 最終合併後 sheet shape：")
+    print_sheet_shapes(merged_shapes, out_name)
+    
+    # ===== 回寫 輸出檔 REQUEST_TABLE N/O/P 欄 =====
+    def set_cells(excel_row, rows, cols, total):
+        ws_req_base[f"N{excel_row}"].value = rows   # Rows
+        ws_req_base[f"O{excel_row}"].value = cols   # Columns
+        ws_req_base[f"P{excel_row}"].value = total  # Total cells
+
+    write_request_table_shapes(merged_shapes, out_name, set_cells)
+
+    wb_base.save(out_path)
+    print(f"✔ 輸出完成：{out_path}")
+    print(f"\n========================\n")
+
+def stream_sheet_rows(target_ws, source_ws, target_shape, dscd_index):
+    """
+    將 source_ws（read-only）的資料列逐列寫到 target_ws（write-only）
+    - 跳過空白列
+    - 寫出的同時更新 target_shape，並在同一次掃描中算出 source 的 shape 回傳
+    - 重複的 Type 交給 dscd_index 判斷是否剔除
+    """
+    source_shape = SheetShape()
     for row in source_ws.iter_rows(min_row=2, values_only=True):
-        # 跳過空白列
+        source_shape.add_row(row)
         if not any(cell is not None for cell in row):
             continue
+        if not dscd_index.keep(source_ws.title, row):
+            continue
         target_ws.append(row)
-    
+        target_shape.add_row(row)
+    return source_shape
+
+def merge_group_streaming(companies, start, end, years, year_idxs, out_name, out_path):
+    """
+    串流合併：
+    - 來源以 read-only 開啟，逐列 iterate，不建立 cell 物件；每張工作表只掃描一次
+    - append 前先比對表頭欄數（只讀第一列），不一致就跳過；資料列的實際欄數在寫出的同時計算，寫完再核對
+    - 輸出以 write-only 開啟，逐列 append，同一時間只有一列在記憶體
+    - REQUEST_TABLE 只複製值（不含格式），N/O/P 於最後依實際寫出列數回寫
+    - 只合併 year_idxs 的工作表；區間外的工作表不讀、不輸出，REQUEST_TABLE 也不留該列
+    """
+    base_file = os.path.join(INPUT_FOLDER, companies[1])
+    wb_base = load_workbook(base_file, read_only=True, data_only=True)
+
+    validate_wb(wb_base, base_file, 1, start, end, years)
+
+    ws_req_base = wb_base[REQUEST_SHEET]
+    base_rows_by_year = get_request_table_value(ws_req_base, "N")
+    base_cols_by_year = get_request_table_value(ws_req_base, "O")
+    req_rows = [list(r) for r in ws_req_base.iter_rows(values_only=True)]
+
+    all_sheets = [s for s in wb_base.sheetnames if s != REQUEST_SHEET]
+    window_sheets = [(i, all_sheets[i]) for i in year_idxs if i < len(all_sheets)]
+    data_sheets = [ws_name for _, ws_name in window_sheets]
+
+    # 區間外年度的 REQUEST_TABLE 列拿掉，N/O/P 回寫時第 i 張表 = 第 7+i 列
+    req_rows = req_rows[:6] + [
+        req_row for i, req_row in enumerate(req_rows[6:])
+        if i >= len(all_sheets) or i in year_idxs
+    ]
+
+    # write-only 的工作表可交錯 append，依模板順序先建立
+    wb_out = Workbook(write_only=True)
+    out_sheets = {
+        name: wb_out.create_sheet(title=name)
+        for name in wb_base.sheetnames
+        if name == REQUEST_SHEET or name in data_sheets
+    }
+    merged_shapes = {ws_name: SheetShape() for ws_name in data_sheets}
+    header_cols = {}    # 模板每張工作表的表頭欄數
+    dscd_index = DscdIndex(DUPLICATE_DSCD)
+
+    sources = chain(
+        [(1, companies[1], wb_base, base_rows_by_year, base_cols_by_year)],
+        open_companies(companies, start, end, years),
+    )
+
+    for company, fname_only, wb_src, _, src_cols_by_year in sources:
+        for year_idx, ws_name in window_sheets:
+            ws_src = wb_src[ws_name]
+            ws_out = out_sheets[ws_name]
+            merged_shape = merged_shapes[ws_name]
+            merged_cols = merged_shape.cols
+
+            header = next(ws_src.iter_rows(max_row=1, values_only=True), None)
+            header_shape = SheetShape()
+            header_shape.add_row(header or ())
+
+            if company == 1:
+                # 模板：header 原樣寫出
+                if header is not None:
+                    ws_out.append(header)
+                header_cols[ws_name] = header_shape.cols
+            elif header_shape.cols != header_cols[ws_name]:
+                print(
+                    f"❌ COLS 不一致 | "
+                    f"{companies[1]} O{7+year_idx}={base_cols_by_year[year_idx]} | "
+                    f"{fname_only} O{7+year_idx}={src_cols_by_year[year_idx]} | "
+                    f"表頭 {header_cols[ws_name]} 欄 vs {header_shape.cols} 欄"
+                )
+                continue  # 不 append
+
+            src_shape = stream_sheet_rows(ws_out, ws_src, merged_shape, dscd_index)
+
+            print(
+                f"{fname_only} 🔹 工作表: {ws_name}, "
+                f"shape: {src_shape.rows} rows x {src_shape.cols} columns"
+            )
+            if company != 1 and src_shape.cols != merged_cols:
+                print(
+                    f"⚠️ {fname_only} {ws_name} 實際 {src_shape.cols} 欄，與已合併的 {merged_cols} 欄不同"
+                    f"（表頭欄數一致，已 append）"
+                )
+
+        dscd_index.end_company(fname_only)
+
+        if wb_src is not wb_base:
+            wb_src.close()
+
+    print(f"\n📊 {out_name} 最終合併後 sheet shape：")
+    print_sheet_shapes(merged_shapes, out_name)
+
+    # ===== 回寫 輸出檔 REQUEST_TABLE N/O/P 欄 =====
+    def set_cells(excel_row, rows, cols, total):
+        while len(req_rows) < excel_row:
+            req_rows.append([])
+        req_row = req_rows[excel_row - 1]
+        req_row.extend([None] * (16 - len(req_row)))
+        req_row[13], req_row[14], req_row[15] = rows, cols, total   # N / O / P
+
+    write_request_table_shapes(merged_shapes, out_name, set_cells)
+
+    for req_row in req_rows:
+        out_sheets[REQUEST_SHEET].append(req_row)
+
+    wb_base.close()
+    wb_out.save(out_path)
+    print(f"✔ 輸出完成：{out_path}")
+    print(f"\n========================\n")
+
+def merge_group(country, start, end, suffix, companies, years, out_name, out_path):
+    """
+    合併單一群組；預檢未通過時不輸出並回傳 False
+    """
+    # ===== 嚴格檢查：一定要有 company = 1 作為模板 =====
+    if 1 not in companies:
+        raise ValueError(
+            f"缺少 company=1，無法合併：{country}-{start}{'-'+end if end else ''}{suffix}"
+        )
+
+    # ===== 預檢：任何公司群的 REQUEST_TABLE 有問題，整組不做 =====
+    if PRECHECK:
+        problems = precheck_group(companies, start, years)
+        if problems:
+            print(f"🚫 {out_name} 預檢未通過，整組略過不輸出：")
+            for problem in problems:
+                print(f"   - {problem}")
+            print(f"\n========================\n")
+            return False
+
+    year_idxs = window_year_indices(start, years)
+    if len(year_idxs) < years:
+        print(
+            f"✂️ {out_name} 只合併 {START_YEAR}~{END_YEAR} 內的 "
+            f"{len(year_idxs)}/{years} 個年度工作表，其餘不讀"
+        )
+
+    if STREAMING_MERGE:
+        merge_group_streaming(companies, start, end, years, year_idxs, out_name, out_path)
+    else:
+        merge_group_inplace(companies, start, end, years, year_idxs, out_name, out_path)
     return True
 
 def main():
@@ -233,6 +725,9 @@ def main():
 
     missing_company_report = []
     existing_outputs = []
+    tasks = []
+    rejected_outputs = []
+    out_of_window = []
 
     for (country, start, end, suffix) in groups.keys():
         out_name = key_to_outname[(country, start, end, suffix)]
@@ -261,6 +756,14 @@ def main():
         print(f"\n========================\n")
 
     for (country, start, end, suffix), items in groups.items():    
+        years = 1 if end is None else int(end) - int(start) + 1
+        out_name = key_to_outname[(country, start, end, suffix)]
+
+        # 整個年段都在 START_YEAR ~ END_YEAR 外：不必讀，直接略過
+        if not window_year_indices(start, years):
+            out_of_window.append(out_name)
+            continue
+
         companies = {company: fname for company, fname in items}
         actual_companies = set(companies.keys())
         expected_companies = set(range(1, expected_company_count + 1))
@@ -273,99 +776,34 @@ def main():
                 "missing": missing_companies
             })
 
-        # ===== 嚴格檢查：一定要有 company = 1 作為模板 =====
-        if 1 not in companies:
-            raise ValueError(
-                f"缺少 company=1，無法合併：{country}-{start}{'-'+end if end else ''}{suffix}"
-            )
-
-        base_company = 1
-        base_file = os.path.join(INPUT_FOLDER, companies[1])
-
-        wb_base = load_workbook(base_file, data_only=True)
-        years = 1 if end is None else int(end) - int(start) + 1
-        merged_rows_by_year = [0] * years
-
-        validate_wb(wb_base, base_file, base_company, start, end, years)
-        print_sheet_shapes(wb_base, companies[1])
-
-        # ===== 先計入 base company 自己的 rows =====
-        base_sheet_names = [s for s in wb_base.sheetnames if s != REQUEST_SHEET]
-
-        for year_idx, ws_name in enumerate(base_sheet_names):
-            ws = wb_base[ws_name]
-            rows = actual_rows(ws)
-            merged_rows_by_year[year_idx] += rows + 1
-
-        for company in sorted(companies):
-            if company == 1:
-                continue
-            fname_only = companies[company]
-            fname = os.path.join(INPUT_FOLDER, fname_only)
-            wb_src = load_workbook(fname, data_only=True)
-
-            ws_req_base = wb_base[REQUEST_SHEET]
-            ws_req_src = wb_src[REQUEST_SHEET]
-
-            base_cols_by_year = get_request_table_value(ws_req_base, "O")
-            src_cols_by_year = get_request_table_value(ws_req_src, "O")
-
-
-            validate_wb(wb_src, fname, company, start, end, years)
-
-            for ws_name in wb_base.sheetnames:
-                # 跳過 REQUEST_TABLE
-                if ws_name == REQUEST_SHEET:
-                    continue
-
-                ws_base = wb_base[ws_name]
-                ws_src = wb_src[ws_name]
-
-                rows = actual_rows(ws_src)
-                cols = actual_cols(ws_src)
-
-                year_idx = list(
-                    s for s in wb_base.sheetnames if s != REQUEST_SHEET
-                ).index(ws_name)
-
-                print(
-                    f"{fname_only} 🔹 工作表: {ws_name}, "
-                    f"shape: {rows} rows x {cols} columns"
-                )
-
-                appended = append_sheet_rows(ws_base, ws_src, fname_only, base_cols_by_year, src_cols_by_year, year_idx)
-
-                if appended:
-                    merged_rows_by_year[year_idx] += rows
-
-        out_name = key_to_outname[(country, start, end, suffix)]
         out_path = os.path.join(OUTPUT_FOLDER, out_name)
 
-        print(f"\n📊 {out_name} 最終合併後 sheet shape：")
-        print_sheet_shapes(wb_base, out_name)
-        
-        # ===== 回寫 輸出檔 REQUEST_TABLE N 欄（Rows）=====
-        ws_req = wb_base[REQUEST_SHEET]
-        data_sheets = [s for s in wb_base.sheetnames if s != REQUEST_SHEET]
-
-        for i, ws_name in enumerate(data_sheets):
-            ws = wb_base[ws_name]
-            rows = actual_rows(ws) + 1       # +1 算 header
-            cols = actual_cols(ws)
-            total = rows * cols
-
-            ws_req[f"N{7+i}"].value = rows   # Rows
-            ws_req[f"O{7+i}"].value = cols   # Columns
-            ws_req[f"P{7+i}"].value = total  # Total cells
-
-            print(
-                f"🧮 {out_name} REQUEST_TABLE row {7+i}: "
-                f"N={rows}, O={cols}, P={total}"
-            )
-
-        wb_base.save(out_path)
-        print(f"✔ 輸出完成：{out_path}")
-        print(f"\n========================\n")
+        tasks.append((country, start, end, suffix, companies, years, out_name, out_path))
+
+    if WORKERS > 1:
+        # 各群組互不相依；log 依群組原順序整塊印出，避免交錯
+        with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+            for task, (log_text, merged, error) in zip(tasks, executor.map(partial(run_buffered, merge_group), tasks)):
+                print(log_text, end="")
+                if error is not None:
+                    executor.shutdown(cancel_futures=True)
+                    raise error
+                if not merged:
+                    rejected_outputs.append(task[-2])
+    else:
+        for task in tasks:
+            if not merge_group(*task):
+                rejected_outputs.append(task[-2])
+
+    if out_of_window:
+        print(f"\n⏭️ 年段不在 {START_YEAR}~{END_YEAR}，未合併的檔案：")
+        for out_name in out_of_window:
+            print(f"   - {out_name}")
+
+    if rejected_outputs:
+        print("\n🚫 預檢未通過、未輸出的檔案：")
+        for out_name in rejected_outputs:
+            print(f"   - {out_name}")
 
     if missing_company_report:
         print("\n⚠️ 公司群數量警示（不影響輸出）")
@@ -0,0 +1,87 @@
+import io
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+import numpy as np
+
+# ========= entity-integrate.py、variable-integrate.py、year-integrate.py 共用的工具 =========
+# 年度區間等設定放在 year_window.py，這裡只放程式碼
+
+class SheetBuffer:
+    """
+    依 REQUEST_TABLE N（含 header 的列數）x O（欄數）預先配置的 2D object 陣列
+    - 資料列直接填進預先配置好的位置，不建立 cell 物件，也不保留整串 tuple
+    - 第一個非空白列當 header；之後的空白列略過並計數（Excel 被更動過會殘留「看不見的空白列」）
+    - N / O 與實際不符時自動擴充
+    """
+    def __init__(self, n_rows, n_cols):
+        self.header = None
+        self.values = np.empty((max(n_rows - 1, 1), max(n_cols, 1)), dtype=object)
+        self.rows = 0         # 已填入的資料列數
+        self.cols = 0         # 資料列實際用到的最大欄數（忽略尾端空欄）
+        self.blank_rows = 0   # 丟棄的空白列數
+
+    @classmethod
+    def from_sheet(cls, ws, n_rows, n_cols):
+        """ws 建議以 read-only 開啟，逐列 iterate"""
+        buf = cls(n_rows or 0, n_cols or 0)
+        for row in ws.iter_rows(values_only=True):
+            if buf.header is None and any(cell is not None for cell in row):
+                buf.header = row
+            else:
+                buf.append(row)
+        return buf
+
+    def append(self, row):
+        width = len(row)
+        while width and row[width - 1] is None:
+            width -= 1
+        if width == 0:
+            self.blank_rows += 1
+            return
+
+        cap_rows, cap_cols = self.values.shape
+        if self.rows == cap_rows or width > cap_cols:
+            grown = np.empty(
+                (cap_rows * 2 if self.rows == cap_rows else cap_rows, max(cap_cols, width)),
+                dtype=object
+            )
+            grown[:self.rows, :cap_cols] = self.values[:self.rows]
+            self.values = grown
+
+        self.values[self.rows, :width] = row[:width]
+        self.rows += 1
+        self.cols = max(self.cols, width)
+
+    def data(self):
+        """已填入的資料（不含 header）"""
+        return self.values[:self.rows, :self.cols]
+
+    def reorder(self, perm):
+        """依 year-integrate.py column_permutation() 的結果整塊重排欄位，header 以外多出的欄維持原位"""
+        data = self.data()
+        width = max(len(perm), self.cols)
+        values = np.empty((max(self.rows, 1), width), dtype=object)
+        for j, i in enumerate(perm):
+            if i < self.cols:
+                values[:self.rows, j] = data[:, i]
+        if self.cols > len(perm):
+            values[:self.rows, len(perm):self.cols] = data[:, len(perm):]
+        self.values = values
+        self.cols = width
+
+def run_buffered(func, task):
+    """
+    process pool 用：func(*task) 的輸出先寫進 buffer，
+    回傳 (log 文字, func 的回傳值, 例外) 給主程序整塊印出
+    - 例外送回主程序時 traceback 會遺失，先寫進 log
+    """
+    buffer = io.StringIO()
+    result = None
+    error = None
+    with redirect_stdout(buffer), redirect_stderr(buffer):
+        try:
+            result = func(*task)
+        except Exception as e:
+            error = e
+            buffer.write(traceback.format_exc())
+    return buffer.getvalue(), result, error
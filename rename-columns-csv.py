@@ -3,8 +3,19 @@ import re
 import os
 import glob
 
-# ========= 自動抓資料夾裡 all- 開頭的 csv，但排除 -renamed  =========
-csv_files = [f for f in glob.glob("all-*.csv") if "-renamed" not in f]  # 抓所有以 all- 開頭的 csv
+# ========= 設定 =========
+# 與 country-integrate.py 的 TYPED_OUTPUT 對應：變數欄讀成浮點數、識別欄讀成 category、缺值為 NaN
+# False 時維持全部字串（dtype=str）
+TYPED_INPUT = False
+MISSING_VALUES = ["", ".", "NA"]
+ID_COLUMNS = ["COUNTRY", "COUNTRY_CODE", "COUNTRY_CODE2", "Type"]
+
+# ========= 自動抓資料夾裡 all- 開頭的 csv，但排除 -renamed 與 country-integrate.py 的長表 / 變數對照表 =========
+EXCLUDED_SUFFIXES = ("-renamed", "-long", "-variables")
+csv_files = [
+    f for f in glob.glob("all-*.csv")
+    if not os.path.splitext(f)[0].endswith(EXCLUDED_SUFFIXES)
+]  # 抓所有以 all- 開頭的 csv
 if not csv_files:
     print("找不到 all- 開頭的 csv 檔案")
     exit()
@@ -47,7 +58,16 @@ if os.path.exists(output_file):
         os.remove(output_file)
         print(f"已刪除舊檔 '{output_file}'。")
 
-df = pd.read_csv(input_file, dtype=str)
+if TYPED_INPUT:
+    df = pd.read_csv(
+        input_file,
+        dtype={c: "category" for c in ID_COLUMNS},
+        na_values=MISSING_VALUES,
+        keep_default_na=False,
+        low_memory=False,
+    )
+else:
+    df = pd.read_csv(input_file, dtype=str)
 
 # ========= Type → DSCD =========
 df = df.rename(columns={"Type": "DSCD"})
@@ -86,5 +106,5 @@ for old, new in zip(original_columns, new_columns):
     if old != new:
         print(f"{old} → {new}")
 
-df.to_csv(output_file, index=False)
+df.to_csv(output_file, index=False, float_format="%.15g" if TYPED_INPUT else None)
 print(f"已生成新檔案 '{output_file}'。")
@@ -1,16 +1,33 @@
+import io
 import os
+import pickle
 import re
+import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
 from datetime import datetime
+from functools import partial
+import numpy as np
 import pandas as pd
 from openpyxl import Workbook, load_workbook
 from openpyxl.utils.dataframe import dataframe_to_rows
 from collections import defaultdict
+from year_window import START_YEAR, END_YEAR    # 年度區間，三支整合程式共用
+from integrate_common import SheetBuffer, run_buffered
 
 DATA_SRC = "./data-split-by-variable"
 DATA_OUT = "./data"
+WORKERS = 1     # >1 時以 process pool 平行處理各國家
+CHECKPOINT_DIR = os.path.join(DATA_OUT, ".checkpoints")  # 每個輸出檔的合併進度，失敗後可接續
 LOG_FILE = f"variable_integrate_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
 
+# pd.read_excel 預設視為缺失值的字串（Datastream 的 "NA" 等），自行讀表時維持相同行為
+NA_STRINGS = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
 os.makedirs(DATA_OUT, exist_ok=True)
 
 # 同時印到終端機 + log 檔案
@@ -46,7 +63,55 @@ def parse_filename(fname):
         for var in vars_
     ]
 
-def get_expected_output_files(parsed, country_year_spans):
+class FileCatalog:
+    """
+    data-split-by-variable 檔名索引：整個目錄只掃一次、每個檔名只解析一次
+    - files：(country, start_year, variable_tag) -> 檔名，Hong-Kong-2015CD 展開成 C、D 兩筆
+    - blocks：(country, start_year, end_year) -> 該年段有哪些變數組
+    - variables：檔名 -> 該檔包含的變數組
+    - country_year_spans：country -> 每個變數組的 (start_year, end_year)
+    """
+    def __init__(self, folder):
+        self.files = {}
+        self.blocks = defaultdict(set)
+        self.variables = defaultdict(list)
+        self.country_year_spans = defaultdict(list)
+
+        for fname in sorted(os.listdir(folder)):
+            if not fname.endswith((".xlsx", ".xlsm")):
+                continue
+
+            parsed = parse_filename(fname)
+            if not parsed:
+                continue
+
+            for country, y1, y2, var, _ in parsed:
+                self.variables[fname].append(var)
+                self.country_year_spans[country].append((y1, y2))
+                self.blocks[(country, y1, y2)].add(var)
+
+                # 如果剛好有兩個（理論上不應該），優先用 .xlsx
+                key = (country, y1, var)
+                if key not in self.files or self.files[key].endswith(".xlsm"):
+                    self.files[key] = fname
+
+    def find(self, country, start_year, var_tag):
+        """找出指定國家、開始年、變數的檔案（A/B/C...），支援單年或跨年"""
+        try:
+            return self.files[(country, start_year, var_tag)]
+        except KeyError:
+            raise FileNotFoundError(
+                f"❌ 找不到 {country}-{start_year}{var_tag}.xlsx 或 .xlsm"
+            ) from None
+
+    def block(self, country, start_year, end_year):
+        """該年段的 (變數組, 檔名)，依 A/B/C 排序"""
+        return [
+            (var, self.find(country, start_year, var))
+            for var in sorted(self.blocks.get((country, start_year, end_year), ()))
+        ]
+
+def get_expected_output_files(country_year_spans):
     outputs = {}  # out_path -> (country, year_label)
 
     for country, spans in country_year_spans.items():
@@ -57,18 +122,12 @@ def get_expected_output_files(parsed, country_year_spans):
             continue
 
         for start_year, end_year in year_span_list:
-            year_label = (
-                f"{start_year}"
-                if start_year == end_year
-                else f"{start_year}-{end_year}"
-            )
-            fname = f"{country}-{year_label}.xlsx"
-            out_path = os.path.join(DATA_OUT, fname)
+            out_path, year_label = output_path(country, start_year, end_year)
             outputs[out_path] = (country, year_label)
 
     return outputs
 
-def create_output_file(country, start_year, end_year):
+def output_path(country, start_year, end_year):
     year_label = (
         f"{start_year}"
         if start_year == end_year
@@ -77,12 +136,13 @@ def create_output_file(country, start_year, end_year):
 
     fname = f"{country}-{year_label}.xlsx"
 
-    out_path = os.path.join(DATA_OUT, fname)
-    
-    files = [f for f in os.listdir(DATA_SRC) if f.endswith((".xlsx", ".xlsm"))]
+    return os.path.join(DATA_OUT, fname), year_label
+
+def create_output_file(country, start_year, end_year, catalog):
+    out_path, _ = output_path(country, start_year, end_year)
 
     try:
-        template_fname = find_excel_file(country, start_year, "A", files)
+        template_fname = catalog.find(country, start_year, "A")
     except FileNotFoundError:
         raise FileNotFoundError(
             f"❌ 找不到 {country}-{start_year}A.xlsx 或 .xlsm 作為模板"
@@ -98,30 +158,8 @@ def create_output_file(country, start_year, end_year):
     if "REQUEST_TABLE" not in wb.sheetnames:
         raise ValueError(f"{template_fname} 中沒有 REQUEST_TABLE 工作表")
     
-    wb.save(out_path)
-    
-    return out_path
-
-def find_excel_file(country, start_year, var_tag, files):
-    """
-    找出指定國家、年份、變數的檔案（A/B/C...）
-    支援單年或跨年
-    """
-    # 精確匹配 country-startyear(-endyear)var_tag
-    pattern = re.compile(
-        rf"^{re.escape(country)}-{start_year}(?:-\d{{4}})?[A-Z]*{var_tag}[A-Z]*\.(xlsx|xlsm)$"
-    )
-    candidates = [f for f in files if pattern.match(f)]
-
-    if not candidates:
-        raise FileNotFoundError(
-            f"❌ 找不到 {country}-{start_year}{var_tag}.xlsx 或 .xlsm"
-        )
-
-    # 如果剛好有兩個（理論上不應該），優先用 .xlsx
-    candidates.sort(key=lambda x: x.endswith(".xlsm"))
-    return candidates[0]
-
+    # 模板直接留在記憶體當輸出檔，最後才存檔，不必先存再重新載入
+    return out_path, wb, template_fname
 
 def check_year_span_consistency(country, year_spans):
     """
@@ -167,11 +205,35 @@ def check_year_span_consistency(country, year_spans):
 
     return True, year_span_list
 
-def read_request_table(xls_path):
-    """讀取 REQUEST_TABLE，回傳 dataframe（row=7 開始）"""
-    return pd.read_excel(
-        xls_path, sheet_name="REQUEST_TABLE", engine="openpyxl", header=None
-    )
+def request_row_year(row):
+    """REQUEST_TABLE 一列（list）的 G 欄年份；不是數字回傳 None"""
+    year = pd.to_numeric(row[6] if len(row) > 6 else None, errors='coerce')
+    return None if pd.isna(year) else int(year)
+
+def sheet_name_from_ref(sheet_ref):
+    """K 欄 sheet_ref 形如: 工作表1'!$A$1"""
+    return sheet_ref.split("!")[0].replace("'", "")
+
+def trim_to_window(wb_out, years):
+    """
+    輸出檔刪掉年度區間外的工作表與 REQUEST_TABLE 列（與 entity-integrate.py 相同）
+    - 由下往上刪，列號才不會跑掉
+    """
+    ws_req = wb_out["REQUEST_TABLE"]
+    trimmed = []
+    for excel_row in range(ws_req.max_row, 6, -1):
+        row = [c.value for c in ws_req[excel_row]]
+        year = request_row_year(row)
+        if year is None or year in years:
+            continue
+        sheet_ref = row[10] if len(row) > 10 else None
+        if isinstance(sheet_ref, str) and sheet_name_from_ref(sheet_ref) in wb_out.sheetnames:
+            del wb_out[sheet_name_from_ref(sheet_ref)]
+        ws_req.delete_rows(excel_row)
+        trimmed.append(year)
+
+    if trimmed:
+        print(f"✂️ 刪除 {START_YEAR}~{END_YEAR} 以外的年度工作表：{', '.join(map(str, sorted(trimmed)))}")
 
 def get_sheet_for_year(req_df, year):
     """根據 REQUEST_TABLE 找到對應年份的工作表位置"""
@@ -193,99 +255,188 @@ def get_sheet_for_year(req_df, year):
     expected_rows = row_series[13]  # N欄
     expected_cols = row_series[14]  # O欄
 
-    # sheet_ref 形如: 工作表1'!$A$1
-    sheet_name = sheet_ref.split("!") [0].replace("'", "")
+    sheet_name = sheet_name_from_ref(sheet_ref)
 
     return sheet_name, int(expected_rows), int(expected_cols), row_idx + 1
 
-def read_variable_data(xls_path, sheet_name):
-    """從指定 sheet 讀資料"""
-    df = pd.read_excel(xls_path, sheet_name=sheet_name, engine="openpyxl")
-    return df
-
-def append_column(wb_out, df, sheet_name, variable_suffix):
+def dedup_columns(header):
+    """
+    與 pd.read_excel 相同的欄名處理：
+    空白欄名補 Unnamed: i，重複欄名依序加 .1、.2 ...
     """
-    以 A 欄 Type 當 primary key 合併
+    columns = []
+    counts = defaultdict(int)
+    for i, col in enumerate(header):
+        if col is None:
+            col = f"Unnamed: {i}"
+        cur_count = counts[col]
+        while cur_count > 0:
+            counts[col] = cur_count + 1
+            col = f"{col}.{cur_count}"
+            cur_count = counts[col]
+        columns.append(col)
+        counts[col] = cur_count + 1
+    return columns
+
+def buffer_to_dataframe(buf):
+    """SheetBuffer → DataFrame（直接包住陣列，欄名 / 缺失值與 pd.read_excel 一致）"""
+    header = list(buf.header or [])
+    while header and header[-1] is None:
+        header.pop()
+    n_cols = max(len(header), buf.cols)
+    header += [None] * (n_cols - len(header))
+
+    values = buf.values[:buf.rows]
+    if values.shape[1] < n_cols:
+        values = np.hstack([values, np.empty((buf.rows, n_cols - values.shape[1]), dtype=object)])
+
+    df = pd.DataFrame(values[:, :n_cols], columns=dedup_columns(header))
+    return df.mask(df.isin(NA_STRINGS))
+
+def buffer_shape(buf):
+    """與 DataFrame.shape 相同的 (資料列數, 欄數)，不必先建 DataFrame"""
+    header = list(buf.header or [])
+    while header and header[-1] is None:
+        header.pop()
+    return buf.rows, max(len(header), buf.cols)
+
+class SourceWorkbook:
     """
+    來源檔只開一次：REQUEST_TABLE 與其引用的年度工作表一次讀進記憶體
+    - req_df：與 pd.read_excel(header=None) 相同排列的 REQUEST_TABLE
+    - sheets：{工作表名稱: SheetBuffer}，依 N x O 預先配置
+    - years：只讀 G 欄年份在其中的工作表，區間外的不 parse
+    - wb：已載入的 workbook（例如 A 模板）可直接傳入，不再重開
+    """
+    def __init__(self, xls_path, wb=None, years=None):
+        self.path = xls_path
+        own_wb = wb is None
+        if own_wb:
+            wb = load_workbook(xls_path, read_only=True, data_only=True)
+
+        try:
+            self.request_rows = [
+                list(r) for r in wb["REQUEST_TABLE"].iter_rows(min_row=1, values_only=True)
+            ]
+            self.req_df = pd.DataFrame(self.request_rows)
+
+            self.sheets = {}
+            for r in self.request_rows[6:]:
+                r = r + [None] * (15 - len(r))
+                sheet_ref, n_rows, n_cols = r[10], r[13], r[14]   # K / N / O 欄
+                if not isinstance(sheet_ref, str):
+                    continue
+                if years is not None and request_row_year(r) not in years:
+                    continue
+                sheet_name = sheet_name_from_ref(sheet_ref)
+                if sheet_name in self.sheets or sheet_name not in wb.sheetnames:
+                    continue
+                self.sheets[sheet_name] = SheetBuffer.from_sheet(
+                    wb[sheet_name],
+                    n_rows if isinstance(n_rows, int) else 0,
+                    n_cols if isinstance(n_cols, int) else 0,
+                )
+        finally:
+            if own_wb:
+                wb.close()
+
+    def request_value(self, excel_row, column):
+        """REQUEST_TABLE 某格的值（excel_row / column 皆從 1 起算）"""
+        if excel_row > len(self.request_rows):
+            return None
+        row = self.request_rows[excel_row - 1]
+        return row[column - 1] if column <= len(row) else None
+
+    def sheet(self, sheet_name):
+        if sheet_name not in self.sheets:
+            raise ValueError(f"{os.path.basename(self.path)} 找不到工作表 {sheet_name}")
+        return self.sheets[sheet_name]
+
+def clean_types(df):
+    """Type 轉字串去空白，丟掉空值 / 空字串"""
+    df = df.dropna(subset=["Type"])     # 丟掉空值
+    df["Type"] = df["Type"].astype(str).str.strip()     # 轉字串
+    return df[df["Type"] != ""]       # 丟掉空字串
 
-    # 讀取現有 sheet
-    if sheet_name in wb_out.sheetnames:
-        ws = wb_out[sheet_name]
+def read_sheet_frame(wb_out, sheet_name):
+    """讀輸出檔（A 模板）既有 sheet 成 DataFrame；不存在時回傳空 DataFrame"""
+    if sheet_name not in wb_out.sheetnames:
+        return pd.DataFrame()
+    data = wb_out[sheet_name].values
+    columns = next(data)
+    return pd.DataFrame(data, columns=columns)
 
-        data = ws.values
-        columns = next(data)
-        base_df = pd.DataFrame(data, columns=columns)
+class SheetJoin:
+    """
+    一張年度工作表的多組變數合併，以 A 欄 Type 當 primary key
+    - add()：每組變數只更新 Type 順序、印出公司差異，DataFrame 先暫存
+    - result()：所有組別到齊後一次多路合併
+    - 列順序：A 原順序在前，各組新出現的公司依組別、原順序接在後面
+    """
+    def __init__(self, sheet_name, base_df, excel_row):
+        self.sheet_name = sheet_name
+        self.excel_row = excel_row
+        self.order = {}     # (Type, 第幾次出現) -> None，保留插入順序
+        self.frames = []    # 各組以 Type 為 index 的 DataFrame
+
+        if not base_df.empty:
+            if "Type" not in base_df.columns:
+                raise ValueError("❌ 既有資料沒有 Type 欄")
+            self._register(clean_types(base_df), "A")
+
+    def _register(self, df, variable_suffix):
+        # 同一 Type 重複出現時，以 (Type, 第幾次出現) 對齊，不做笛卡兒積
+        occurrence = df.groupby("Type", sort=False).cumcount()
+        if occurrence.any():
+            print(
+                f"⚠️ {self.sheet_name}{variable_suffix} Type 重複 "
+                f"{', '.join(sorted(set(df.loc[occurrence > 0, 'Type'])))}，依出現順序逐筆對齊"
+            )
+        keys = pd.MultiIndex.from_arrays([df["Type"], occurrence], names=["Type", "_n"])
+        self.order.update(dict.fromkeys(keys))
+        self.frames.append(df.drop(columns="Type").set_index(keys))
 
-    else:
-        # 如果不存在，直接寫入
-        base_df = pd.DataFrame()
+    def types(self):
+        return {t for t, _ in self.order}
 
-    # 整理新資料
-    df = df.copy()
-    df.columns = df.columns.astype(str)
+    def add(self, df, variable_suffix):
+        sheet_name = self.sheet_name
 
-    if "Type" not in df.columns:
-        raise ValueError("❌ 新資料沒有 Type 欄")
-    
-    df = df.dropna(subset=["Type"])     # 丟掉空值
-    df["Type"] = df["Type"].astype(str).str.strip()     # 轉字串
-    df = df[df["Type"] != ""]       # 丟掉空字串
+        # 整理新資料
+        df = df.copy()
+        df.columns = df.columns.astype(str)
 
-    # 如果 base 是空
-    if base_df.empty:
-        merged_df = df
+        if "Type" not in df.columns:
+            raise ValueError("❌ 新資料沒有 Type 欄")
 
-    else:
-        if "Type" not in base_df.columns:
-            raise ValueError("❌ 既有資料沒有 Type 欄")
-        
-        base_df = base_df.dropna(subset=["Type"])     # 丟掉空值
-        base_df["Type"] = base_df["Type"].astype(str).str.strip()     # 轉字串
-        base_df = base_df[base_df["Type"] != ""]       # 丟掉空字串
-        
-        # 清掉殘留欄位
-        if "_order" in base_df.columns:
-            base_df = base_df.drop(columns="_order")
-
-        # 保留原順序
-        base_df["_order"] = range(len(base_df))
+        df = clean_types(df)
 
-        # 拿新資料「除了 Type 以外」的欄
-        new_cols = [c for c in df.columns if c != "Type"]
+        # 如果 base 是空，第一組直接當 base
+        if not self.order:
+            self._register(df, variable_suffix)
+            return
 
         # ========= 公司差異分析 =========
-        base_types = list(base_df["Type"])
+        base_keys = list(self.order)
+        base_types = self.types()
         new_types = list(df["Type"])
 
-        base_index_map = {t: i+2 for i, t in enumerate(base_types)}  # +2 因為 Excel 有表頭
+        base_index_map = {t: i+2 for i, (t, _) in enumerate(base_keys)}  # +2 因為 Excel 有表頭
         new_index_map = {t: i+2 for i, t in enumerate(new_types)}
 
-        set_base = set(base_types)
         set_new = set(new_types)
 
-        only_in_new = sorted(set_new - set_base)
-        only_in_base = sorted(set_base - set_new)
+        only_in_new = sorted(set_new - base_types)
+        only_in_base = sorted(base_types - set_new)
 
-        merged_df = pd.merge(
-            base_df,
-            df[["Type"] + new_cols],
-            on="Type",
-            how="outer",
-            sort=False
-        )
-
-        # 排序：A 原順序在前，新公司排後
-        merged_df = merged_df.sort_values("_order", na_position="last")
-        merged_df = merged_df.drop(columns=["_order"])
-
-        # 重新建立 index map
-        final_index_map = {
-            t: i+2 for i, t in enumerate(merged_df["Type"])
-        }
+        # 新公司依原順序接在最後
+        final_index_map = {}
+        for t in new_types:
+            if t not in base_types and t not in final_index_map:
+                final_index_map[t] = len(base_keys) + len(final_index_map) + 2
 
         # -------- 新公司 --------
-        for idx, company in enumerate(only_in_new):
-            new_row_position = len(base_types) + idx + 2
+        for company in only_in_new:
             print(
                 f"新公司 {company} 出現在 {sheet_name}{variable_suffix} 的第 {new_index_map[company]} 列，"
                 f"加進 {sheet_name}A 的第 {final_index_map[company]} 列"
@@ -299,48 +450,69 @@ def append_column(wb_out, df, sheet_name, variable_suffix):
                 f"該公司 {variable_suffix} 組變數的值全部補 ."
             )
 
-    # 將 NaN 轉為 "."
-    merged_df = merged_df.fillna(".")
+        # 拿新資料「除了 Type 以外」的欄
+        new_cols = [c for c in df.columns if c != "Type"]
+        self._register(df[["Type"] + new_cols], variable_suffix)
+
+    def result(self):
+        """所有組別一次對齊到最終 Type 順序後橫向合併，NaN 轉為 "."
+        - 欄名與前面組別重複時比照逐組 pd.merge：前面的加 _x、新的加 _y，欄名維持唯一
+        """
+        index = pd.MultiIndex.from_tuples(list(self.order), names=["Type", "_n"])
+        frames = []
+        for f in self.frames:
+            f = f.reindex(index)
+            used = {c for prev in frames for c in prev.columns}
+            overlap = [c for c in f.columns if c in used]
+            if overlap:
+                print(f"⚠️ {self.sheet_name} 欄名重複 {', '.join(map(str, overlap))}，加上 _x / _y 區分")
+                frames = [prev.rename(columns={c: f"{c}_x" for c in overlap}) for prev in frames]
+                f = f.rename(columns={c: f"{c}_y" for c in overlap})
+            frames.append(f)
+        merged_df = pd.concat(frames, axis=1)
+        merged_df = merged_df.reset_index(level="_n", drop=True).reset_index()
+        return merged_df.fillna(".")
+
+def check_request_rows(wb_out, source, out_path, excel_row):
+    """檢查 N 欄 (Rows) 是否與來源檔一致"""
+    N_COL = 14  # column N
+
+    n_out = wb_out["REQUEST_TABLE"].cell(row=excel_row, column=N_COL).value
+    n_src = source.request_value(excel_row, N_COL)
+
+    if n_out != n_src:
+        print(
+            f"⚠️ ROWS 不一致 | "
+            f"{os.path.basename(out_path)} N{excel_row}={n_out} | "
+            f"{os.path.basename(source.path)} N{excel_row}={n_src}"
+        )
+
+def write_joined_sheet(wb_out, join):
+    """
+    合併結果一次寫回（保留原工作表位置），
+    並直接以 DataFrame shape 更新 REQUEST_TABLE N/O/P
+    """
+    merged_df = join.result()
+    sheet_name = join.sheet_name
 
     # 清空舊 sheet
+    index = None
     if sheet_name in wb_out.sheetnames:
+        index = wb_out.sheetnames.index(sheet_name)
         wb_out.remove(wb_out[sheet_name])
 
-    ws = wb_out.create_sheet(title=sheet_name)
+    ws = wb_out.create_sheet(title=sheet_name, index=index)
 
     # 寫回
     for r in dataframe_to_rows(merged_df, index=False, header=True):
         ws.append(r)
 
-def update_request_table(wb_out, src_path, out_path, excel_row, sheet_name):
-    """
-    先檢查 N 欄是否與來源檔一致，
-    再以合併後的 sheet 實際資料計算 N/O/P，更新 REQUEST_TABLE，
-    並印出加總過程
-    """
-    wb_src = load_workbook(src_path)
-
+    # ========= 以合併後的 shape 更新 =========
     ws_out = wb_out["REQUEST_TABLE"]
-    ws_src = wb_src["REQUEST_TABLE"]
-
-    # ========= 先檢查 N 欄 (Rows) =========
-    N_COL = 14  # column N
-
-    n_out = ws_out.cell(row=excel_row, column=N_COL).value
-    n_src = ws_src.cell(row=excel_row, column=N_COL).value
+    excel_row = join.excel_row
 
-    if n_out != n_src:
-        print(
-            f"⚠️ ROWS 不一致 | "
-            f"{os.path.basename(out_path)} N{excel_row}={n_out} | "
-            f"{os.path.basename(src_path)} N{excel_row}={n_src}"
-        )
-
-    # ========= 以合併後 sheet 的實際 shape 更新 =========
-    ws_data = wb_out[sheet_name]
-
-    rows = actual_rows(ws_data) + 1  # header 算一列
-    cols = actual_cols(ws_data)
+    rows = len(merged_df) + 1  # header 算一列
+    cols = len(merged_df.columns)
     total = rows * cols
 
     ws_out[f"N{excel_row}"].value = rows
@@ -350,49 +522,213 @@ def update_request_table(wb_out, src_path, out_path, excel_row, sheet_name):
     print(f"🧮 更新 REQUEST_TABLE {sheet_name} row {excel_row}: "
           f"N={rows}, O={cols}, P={total}")
 
-def actual_rows(ws):
+def checkpoint_dir(out_path):
+    return os.path.join(CHECKPOINT_DIR, os.path.basename(out_path))
+
+def group_checkpoint_path(out_path, fname):
+    return os.path.join(checkpoint_dir(out_path), fname + ".pkl")
+
+def source_signature(fname):
+    """來源檔 (大小, 修改時間)，用來判斷 checkpoint 是否還能沿用"""
+    st = os.stat(os.path.join(DATA_SRC, fname))
+    return st.st_size, st.st_mtime_ns
+
+def load_group_checkpoint(out_path, fname, years):
     """
-    計算實際有資料的 row 數（忽略尾端空白列）
+    讀取某組變數上次完成時存下的資料；沒有、讀不到、來源檔已變更或年度區間不同時回傳 None
+    回傳 {工作表名稱: (REQUEST_TABLE 列號, DataFrame)}
     """
-    last = 0
-    for i, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=1):
-        if any(cell is not None for cell in row):
-            last = i
-    return last
+    path = group_checkpoint_path(out_path, fname)
+    if not os.path.exists(path):
+        return None
 
-def actual_cols(ws):
+    try:
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state["source"] != source_signature(fname):
+            print(f"⚠️ {fname} 已變更，捨棄 checkpoint")
+            os.remove(path)
+            return None
+        if state.get("years") != tuple(years):
+            print(f"⚠️ {fname} 的 checkpoint 年度區間與 {START_YEAR}~{END_YEAR} 不同，捨棄 checkpoint")
+            os.remove(path)
+            return None
+    except Exception as e:
+        print(f"⚠️ 無法讀取 checkpoint {path}：{e}，重新合併")
+        os.remove(path)
+        return None
+    return state["sheets"]
+
+def save_group_checkpoint(out_path, fname, years, sheets):
     """
-    計算實際有資料的欄位數（忽略尾端空欄）
+    每完成一組變數存一個檔，只存該組自己的資料（不重寫前面組別）
+    - 只存 dict / DataFrame，不存本程式的 class，process pool 寫的檔單一 process 也讀得到
+    - 記下年度區間，START_YEAR / END_YEAR 改過就不沿用
+    - 先寫暫存檔再 rename，中斷時不會留下半個 checkpoint
     """
-    max_cols = 0
-    for row in ws.iter_rows(min_row=2, values_only=True):
-        if not row:
+    os.makedirs(checkpoint_dir(out_path), exist_ok=True)
+    path = group_checkpoint_path(out_path, fname)
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "wb") as f:
+        pickle.dump(
+            {"source": source_signature(fname), "years": tuple(years), "sheets": sheets},
+            f, protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    os.replace(tmp_path, path)
+
+def clear_checkpoint(out_path):
+    shutil.rmtree(checkpoint_dir(out_path), ignore_errors=True)
+
+def add_to_join(joins, wb_out, sheet_name, excel_row, df, var):
+    """把一組變數某張工作表的資料加進對應的 SheetJoin"""
+    if sheet_name not in joins:
+        joins[sheet_name] = SheetJoin(
+            sheet_name, read_sheet_frame(wb_out, sheet_name), excel_row
+        )
+    joins[sheet_name].add(df, var)
+
+def integrate_country(country, year_spans, catalog):
+    """
+    整合單一國家的所有 year_span
+    - 已存在的輸出檔直接略過
+    - 每完成一組變數存 checkpoint；某組失敗時保留 checkpoint 並略過該國後續年度，
+      下次執行只重做未完成的組別
+    - 輸出先寫暫存檔再 rename，./data 不會出現寫到一半的檔案
+    """
+    # 先檢查該國所有檔案的年段是否一致
+    is_consistent, year_span_list = check_year_span_consistency(
+        country, year_spans
+    )
+    if not is_consistent:
+        return   # 整個國家直接跳過，不輸出
+
+    print(f"\n========== ▶ 開始處理 {country} ==========")
+
+    for start_year, end_year in year_span_list:
+        print("\n" + "-" * 40)
+        out_xlsx, year_label = output_path(country, start_year, end_year)
+
+        # 只處理 START_YEAR ~ END_YEAR 內的年度，整段在區間外就不開檔
+        window_years = range(max(start_year, START_YEAR), min(end_year, END_YEAR) + 1)
+        if not window_years:
+            print(f"⏭️ {country}-{year_label} 不在 {START_YEAR}~{END_YEAR}，略過")
+            continue
+        if len(window_years) < end_year - start_year + 1:
+            print(
+                f"✂️ {country}-{year_label} 只合併 {START_YEAR}~{END_YEAR} 內的 "
+                f"{len(window_years)}/{end_year - start_year + 1} 個年度工作表，其餘不讀"
+            )
+
+        if os.path.exists(out_xlsx):
+            print(f"⏭️ {os.path.basename(out_xlsx)} 已存在，略過")
             continue
-        # 找最後一個非 None 的 index
-        for i in range(len(row), 0, -1):
-            if row[i-1] is not None:
-                max_cols = max(max_cols, i)
+
+        out_xlsx, wb_out, template_fname = create_output_file(
+            country, start_year, end_year, catalog
+        )
+        skip_country = False
+
+        # 這個 block 的檔案，A/B/C 排序，以第一個最小字母先處理
+        block_files = catalog.block(country, start_year, end_year)
+
+        # 記錄已處理 Excel；joins: sheet_name -> SheetJoin，所有變數組到齊後一次合併
+        processed_files = set()
+        joins = {}
+
+        for var, fname in block_files:
+            if fname in processed_files:
+                continue  # 否則 Hong-Kong-2015CD 會被併 2 次
+            processed_files.add(fname)  # 標記 Hong-Kong-2015CD 已處理
+
+            # 上次已完成的組別：依原順序把存下的資料加回 join，不必重讀來源檔
+            done_sheets = load_group_checkpoint(out_xlsx, fname, window_years)
+            if done_sheets is not None:
+                print(f"♻️ 從 checkpoint 接續 {fname}")
+                with redirect_stdout(io.StringIO()):     # 公司差異訊息上次已印過
+                    for sheet_name, (excel_row, df) in done_sheets.items():
+                        add_to_join(joins, wb_out, sheet_name, excel_row, df, var)
+                continue
+
+            src_path = os.path.join(DATA_SRC, fname)
+            is_first_variable = ("A" in catalog.variables[fname])
+            print(f"📂 處理 {src_path}")
+            group_sheets = {}   # 這組變數各工作表的資料，完成後存成 checkpoint
+
+            # 整個檔案只開一次；A 模板直接沿用已載入的輸出 workbook
+            try:
+                source = SourceWorkbook(
+                    src_path, wb=wb_out if fname == template_fname else None, years=window_years
+                )
+            except Exception as e:
+                print(f"⚠️ ERROR: {e}")
+                skip_country = True
                 break
-    return max_cols
 
-def main():
-    files = [f for f in os.listdir(DATA_SRC) if f.endswith((".xlsx", ".xlsm"))]
+            for year in window_years:
+                try:
+                    sheet_name, exp_rows, exp_cols, excel_row = get_sheet_for_year(source.req_df, year)
+                    buf = source.sheet(sheet_name)
+                    df_rows, df_cols = buffer_shape(buf)  # 不含 header，會少一 row
 
-    parsed = []
-    for f in files:
-        parsed.extend(parse_filename(f))
+                    actual_rows = df_rows + 1
+                    actual_cols = df_cols
+
+                    # 檢查尺寸
+                    if actual_rows != exp_rows or actual_cols != exp_cols:
+                        print(f"⚠️ {country}-{start_year}-{end_year}{var} rows/cols 不符"
+                            f"   Expected: {exp_rows} rows x {exp_cols} cols\n"
+                            f"   Actual:   {actual_rows} rows x {actual_cols} cols"
+                        )
+                        skip_country = True
+                        break
+                    else:
+                        print(f"🔹 工作表: {sheet_name}, shape: {exp_rows} rows x {exp_cols} columns")
+
+                    if is_first_variable:   # A 組變數作為模板，已經在新檔裡，skip
+                        continue
+
+                    df = buffer_to_dataframe(buf)
+                    add_to_join(joins, wb_out, sheet_name, excel_row, df, var)
+                    group_sheets[sheet_name] = (excel_row, df)
+
+                    check_request_rows(wb_out, source, out_xlsx, excel_row)
+                except Exception as e:
+                    print(f"⚠️ ERROR: {e}")
+                    skip_country = True
+                    break   # 跳出 var 迴圈，外層會處理 checkpoint + 換國
+
+            if skip_country:
+                break
+
+            # 這組變數所有年度都合併完成才存 checkpoint，失敗的組別下次整組重做
+            save_group_checkpoint(out_xlsx, fname, window_years, group_sheets)
+
+        if skip_country:
+            if os.path.isdir(checkpoint_dir(out_xlsx)):
+                print(f"💾 保留 checkpoint {checkpoint_dir(out_xlsx)}，下次執行只重做未完成的變數組")
+            print(f"⏭️ 不輸出 {out_xlsx}")
+            break   # 跳出 year 迴圈 (略過後續年度)，換下一國
+
+        for join in joins.values():
+            write_joined_sheet(wb_out, join)
+
+        # REQUEST_TABLE 列號在合併時要與來源檔一致，最後才刪區間外的年度
+        trim_to_window(wb_out, window_years)
+
+        # 先寫暫存檔再 rename，避免中斷時留下寫到一半的 xlsx
+        tmp_xlsx = out_xlsx + ".tmp"
+        wb_out.save(tmp_xlsx)
+        os.replace(tmp_xlsx, out_xlsx)
+        clear_checkpoint(out_xlsx)
+
+def main():
+    # 整個來源目錄只掃一次，之後都查 catalog
+    catalog = FileCatalog(DATA_SRC)
+    country_year_spans = catalog.country_year_spans
 
-    # 依國家 -> 年度 -> 變數排序（A, B, C...）
-    grouped = defaultdict(lambda: defaultdict(list))  # country -> year -> list of (var, fname)
-    country_year_spans = defaultdict(list)
-    
-    for country, y1, y2, var, fname in parsed:
-        country_year_spans[country].append((y1, y2))
-        for y in range(y1, y2 + 1):
-            grouped[country][y].append((var, fname))
-    
     # 檢查之前是否已輸出過
-    expected_outputs = get_expected_output_files(parsed, country_year_spans)
+    expected_outputs = get_expected_output_files(country_year_spans)
 
     existing_outputs = {
         path: meta
@@ -418,106 +754,30 @@ def main():
 
             elif ans == "n":
                 print(
-                    "\n⏭️ 未刪除任何檔案。\n"
-                    "請自行至 ./data 刪除欲重新產生的檔案後再執行。"
+                    "\n⏭️ 未刪除任何檔案，已存在的輸出檔會略過，其餘繼續整合。\n"
+                    "若要重新產生特定檔案，請自行至 ./data 刪除後再執行。"
                 )
-                return
+                break
 
             else:
                 print("請輸入 y 或 n")
 
-    for country, spans in grouped.items():
-
-        # 先檢查該國所有檔案的年段是否一致
-        is_consistent, year_span_list = check_year_span_consistency(
-            country, country_year_spans[country]
-        )
-        if not is_consistent:
-            continue   # 整個國家直接跳過，不輸出
-
-        print(f"\n========== ▶ 開始處理 {country} ==========")
-
-        for start_year, end_year in year_span_list:
-            print("\n" + "-" * 40)
-            out_xlsx = create_output_file(country, start_year, end_year)
-            if out_xlsx is None:
-                continue   # 這個年度已做過，直接跳過
-            wb_out = load_workbook(out_xlsx)
-            skip_country = False
-
-            # 篩選這個 block 的檔案
-            block_files = [
-                (y1, y2, var, fname)
-                for parsed_country, y1, y2, var, fname in parsed
-                if parsed_country == country and y1 >= start_year and y2 <= end_year
-            ]
-            block_files = sorted(block_files, key=lambda x: x[2])  # A/B/C 排序，以第一個最小字母先處理
-            
-            processed_files = set() # 記錄已處理 Excel
-
-            for s, e, var, _ in block_files:
-                fname = find_excel_file(country, s, var, files)
-                if fname in processed_files:
-                    continue  # 否則 Hong-Kong-2015CD 會被併 2 次
-                processed_files.add(fname)  # 標記 Hong-Kong-2015CD 已處理
-
-                src_path = os.path.join(DATA_SRC, fname)
-                vars_in_file = [v for _, _, v, f in block_files if f == fname]
-                is_first_variable = ("A" in vars_in_file)
-                print(f"📂 處理 {src_path}")
-
-                req_df = read_request_table(src_path)
-
-                for year in range(s, e+1):
-                    try:
-                        sheet_name, exp_rows, exp_cols, excel_row = get_sheet_for_year(req_df, year)
-                        df = read_variable_data(src_path, sheet_name)
-                        df_rows, df_cols = df.shape  # DataFrame 不含 header，會少一 row
-
-                        actual_rows = df_rows + 1
-                        actual_cols = df_cols
-
-                        # 檢查尺寸
-                        if actual_rows != exp_rows or actual_cols != exp_cols:
-                            print(f"⚠️ {country}-{start_year}-{end_year}{var} rows/cols 不符"
-                                f"   Expected: {exp_rows} rows x {exp_cols} cols\n"
-                                f"   Actual:   {actual_rows} rows x {actual_cols} cols"
-                            )
-                            skip_country = True
-                            break
-                        else:
-                            print(f"🔹 工作表: {sheet_name}, shape: {exp_rows} rows x {exp_cols} columns")
-
-                        if is_first_variable:   # A 組變數作為模板，已經在新檔裡，skip
-                            continue
-
-                        append_column(
-                            wb_out=wb_out,
-                            df=df,
-                            sheet_name=sheet_name,
-                            variable_suffix=var
-                        )
-
-                        if not is_first_variable:
-                            update_request_table(
-                                wb_out=wb_out,
-                                src_path=src_path,
-                                out_path=out_xlsx,
-                                excel_row=excel_row,
-                                sheet_name=sheet_name
-                            )
-                    except Exception as e:
-                        print(f"⚠️ ERROR: {e}")
-                        skip_country = True
-                        break   # 跳出 var 迴圈，外層會處理刪檔 + 換國
-            
-            wb_out.save(out_xlsx)   
+    tasks = [
+        (country, year_spans, catalog)
+        for country, year_spans in country_year_spans.items()
+    ]
 
-            if skip_country:
-                if os.path.exists(out_xlsx):
-                    print(f"🗑️ 刪除檔案 {out_xlsx}")
-                    os.remove(out_xlsx)
-                break   # 跳出 year 迴圈 (略過後續年度)，換下一國
+    if WORKERS > 1:
+        # 各國輸出檔互不相依；log 依國家原順序整塊印出
+        with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+            for log_text, _, error in executor.map(partial(run_buffered, integrate_country), tasks):
+                print(log_text, end="")
+                if error is not None:
+                    executor.shutdown(cancel_futures=True)
+                    raise error
+    else:
+        for task in tasks:
+            integrate_country(*task)
 
     print("🎉 所有國家/年度整合完成！")
 
@@ -1,10 +1,17 @@
 import os
+import hashlib
+import json
+import numpy as np
 import pandas as pd
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import partial
 from collections import defaultdict
 from openpyxl import load_workbook, Workbook
+from year_window import START_YEAR, END_YEAR    # 年度區間，三支整合程式共用
+from integrate_common import SheetBuffer, run_buffered
 
 # ========= 基本設定 =========
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -12,8 +19,11 @@ SRC_DIR = os.path.join(BASE_DIR, "data")
 OUT_DIR = os.path.join(BASE_DIR, "data-2015-2024")
 LOG_FILE = f"year_integrate_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
 
-START_YEAR = 2015
-END_YEAR = 2024
+# True：read-only 逐年讀、write-only 逐列寫，記憶體不隨年數成長
+# False：整國資料先讀進記憶體再一次寫出
+STREAMING = True
+
+WORKERS = 1     # >1 時以 process pool 平行處理各國家；log 仍依國家順序整塊寫出
 
 os.makedirs(OUT_DIR, exist_ok=True)
 
@@ -56,56 +66,251 @@ def extract_sheet_name(ref):
     """從 K 欄 'Sheet1'!$A$1 抽出 Sheet1"""
     return ref.split("!")[0].replace("'", "")
 
-def main():
-    # ========= 收集各國檔案 =========
-    country_files = defaultdict(list)
+class PanelPresence:
+    """
+    每個 DSCD（Type 欄）一個 int bitmask：第 k 個 bit = START_YEAR + k 年有資料
+    寫出資料列時順手記錄，不必事後再讀 CSV 分組
+    """
+    def __init__(self, header):
+        # header 為來源工作表欄名（不含 YEAR）；找不到 Type 就用第一欄
+        header = list(header)
+        self.type_idx = header.index("Type") if "Type" in header else 0
+        self.masks = {}
+
+    def add(self, dscd, year):
+        if dscd is None:
+            return
+        self.masks[dscd] = self.masks.get(dscd, 0) | (1 << (year - START_YEAR))
+
+    def add_row(self, row, year):
+        if self.type_idx < len(row):
+            self.add(row[self.type_idx], year)
+
+    def add_column(self, values, year):
+        bit = 1 << (year - START_YEAR)
+        masks = self.masks
+        for dscd in values:
+            if dscd is not None:
+                masks[dscd] = masks.get(dscd, 0) | bit
+
+    def report(self, country):
+        """平衡 / 不平衡公司數，以及不平衡公司缺的年份"""
+        n_years = END_YEAR - START_YEAR + 1
+        full = (1 << n_years) - 1
+
+        by_years_present = defaultdict(int)
+        gaps = {}
+        for dscd, mask in self.masks.items():
+            by_years_present[bin(mask).count("1")] += 1
+            if mask != full:
+                gaps[str(dscd)] = [
+                    START_YEAR + k for k in range(n_years) if not mask >> k & 1
+                ]
+
+        return {
+            "country": country,
+            "years": [START_YEAR, END_YEAR],
+            "firms": len(self.masks),
+            "balanced": len(self.masks) - len(gaps),
+            "unbalanced": len(gaps),
+            "firms_by_years_present": {
+                str(k): by_years_present[k] for k in sorted(by_years_present, reverse=True)
+            },
+            "gaps": gaps,
+        }
+
+def write_panel_report(panel, country, out_path):
+    """MASTER_TABLE 旁邊輸出 -panel.json，記錄 panel 平衡程度"""
+    report = panel.report(country)
+    report_path = os.path.splitext(out_path)[0] + "-panel.json"
+
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=1, default=str)
+
+    print(
+        f"  📊 panel：{report['firms']} 家公司，"
+        f"平衡 {report['balanced']}、不平衡 {report['unbalanced']} → {report_path}"
+    )
+
+def header_names(header):
+    """去掉尾端空欄後的欄名 tuple"""
+    width = len(header)
+    while width and header[width - 1] is None:
+        width -= 1
+    return tuple(header[:width])
+
+def header_fingerprint(names):
+    """欄名 tuple 的指紋；欄名、順序都一樣才相同"""
+    return hashlib.sha1(repr(names).encode("utf-8")).hexdigest()[:16]
+
+def column_permutation(ref_names, names):
+    """
+    names 若只是 ref_names 換了順序，回傳 perm：第 j 欄取來源第 perm[j] 欄
+    欄名集合不同就回傳 None
+    - 重複欄名依第幾次出現對應
+    """
+    def keyed(cols):
+        seen = defaultdict(int)
+        keys = []
+        for c in cols:
+            keys.append((c, seen[c]))
+            seen[c] += 1
+        return keys
+
+    position = {key: i for i, key in enumerate(keyed(names))}
+    ref_keys = keyed(ref_names)
+    if len(ref_keys) != len(position) or any(key not in position for key in ref_keys):
+        return None
+    return [position[key] for key in ref_keys]
+
+def realign_row(row, perm):
+    """串流時逐列套用預先算好的 perm，只做 list 索引，不逐格查欄名"""
+    width = len(row)
+    return [row[i] if i < width else None for i in perm] + list(row[len(perm):])
+
+def print_header_mismatch(country, year, ref_year, ref_names, names):
+    print(f"❌ 欄位名稱不一致，已略過該年份！國家：{country} 年份：{year}")
+    print(f"  {ref_year} 年有、{year} 年沒有：{[c for c in ref_names if c not in names]}")
+    print(f"  {year} 年有、{ref_year} 年沒有：{[c for c in names if c not in ref_names]}")
+
+def read_sheet_header(ws):
+    """
+    回傳某張年度工作表的 (header, 指紋)，整張空白回傳 (None, None)
+    - header 維持讀到的原值，不轉型
+    """
+    header = first_nonblank_row(ws)
+    if header is None:
+        return None, None
+    return list(header), header_fingerprint(header_names(header))
 
-    for f in os.listdir(SRC_DIR):
-        if f.lower().endswith((".xlsm", ".xlsx")):
-            country_files[parse_country(f)].append(f)
+def lookup_country_codes(display_country, country_code_map):
+    """country-code.xlsx 對照表查 (COUNTRY_CODE, COUNTRY_CODE2)，查不到給空字串"""
+    code_info = country_code_map.get(display_country, {"Country_code": "", "Country_code2": ""})
+    return code_info.get("Country_code", ""), code_info.get("Country_code2", "")
 
-    # ---- 讀 country code 對照表 ----
-    code_df = pd.read_excel(os.path.join(BASE_DIR, "country-code.xlsx"))
-    code_df["Country_name"] = code_df["Country_name"].str.strip()
+def country_header(header):
+    """把 COUNTRY / COUNTRY_CODE / COUNTRY_CODE2 三欄插到 YEAR 之後"""
+    return header[:1] + ["COUNTRY", "COUNTRY_CODE", "COUNTRY_CODE2"] + header[1:]
 
-    country_code_map = code_df.set_index("Country_name").to_dict(orient="index")
+def check_years(country, years_present):
+    """
+    years_present：有資料的年份（已排序）
+    - 完整性：START_YEAR ~ END_YEAR 每年都要有
+    - 連續性：最小年 ~ 最大年中間不能斷
+    任一條件不符合就印出原因，回傳 False
+    """
+    # ---- 檢查年份完整性 ----
+    required_years = set(range(START_YEAR, END_YEAR + 1))
+    missing_required = sorted(required_years - set(years_present))
+
+    # ---- 檢查年份連續性 ----
+    min_year = min(years_present)
+    max_year = max(years_present)
+    full_range = set(range(min_year, max_year + 1))
+    missing_continuous = sorted(full_range - set(years_present))
+
+    # ---- 若任一條件不符合就跳過 ----
+    if missing_required or missing_continuous:
+        msg = f"⚠ {country} 資料不完整或不連續｜實際年份: {years_present}"
+        if missing_required:
+            msg += f" | 年份不完整，缺少: {', '.join(str(y) for y in missing_required)}"
+        if missing_continuous:
+            msg += f" | 年份不連續，缺少: {', '.join(str(y) for y in missing_continuous)}"
+        print(msg)
+        return False
+
+    return True
+
+def iter_request_table(req_ws):
+    """
+    REQUEST_TABLE 從第 7 列一直往下讀，讀到空白就停
+    逐列回傳 (year, K 欄 sheet ref, N 欄 rows, O 欄 cols)
+    """
+    for r in req_ws.iter_rows(min_row=7, max_col=15, values_only=True):
+        r = r + (None,) * (15 - len(r))
+        year, ref = r[6], r[10]     # G, K
 
-    # ========= 主流程 =========
-    for country, files in country_files.items():
-        print(f"\nProcessing {country}...")
+        if year is None or ref is None:
+            break
+
+        yield int(year), ref, r[13], r[14]   # N, O
+
+def first_nonblank_row(ws):
+    """read-only 工作表的第一個非空白列（header），整張空白回傳 None"""
+    for row in ws.iter_rows(values_only=True):
+        if any(cell is not None for cell in row):
+            return row
+    return None
+
+def stream_sheet_rows(out_ws, src_ws, prefix, perm=None, panel=None):
+    """
+    把一張年度工作表的資料列逐列寫進 write-only 的 MASTER_TABLE
+    - 第一個非空白列是 header，不寫
+    - 每列前面接上 prefix（YEAR / COUNTRY / COUNTRY_CODE / COUNTRY_CODE2）
+    - perm 不是 None 時（欄位順序與第一年不同）逐列重排
+    - panel 不是 None 時順手記錄 DSCD 出現的年份（prefix[0] 是 YEAR）
+    - 空白列略過並計數
+    回傳 (寫入列數, 空白列數)
+    """
+    n_rows = 0
+    blank_rows = 0
+    seen_header = False
 
-        display_country = country.replace("-", " ") # 取得 COUNTRY 欄
+    for row in src_ws.iter_rows(values_only=True):
+        width = len(row)
+        while width and row[width - 1] is None:
+            width -= 1
 
-        records = []            # 暫存 某個國家 各年度的資料
-        header = None
-        expected_cols = None    # 紀錄該國家應有的欄位數
-        year_col_count = {}     # 紀錄每年欄位數（方便報錯）
+        if not seen_header:
+            seen_header = width > 0
+            continue
+
+        if width == 0:
+            blank_rows += 1
+            continue
+
+        data = list(row[:width]) if perm is None else realign_row(row[:width], perm)
+        out_ws.append(prefix + data)
+        if panel is not None:
+            panel.add_row(data, prefix[0])
+        n_rows += 1
+
+    return n_rows, blank_rows
+
+def integrate_country_streaming(country, files, country_code_map):
+    """
+    串流模式：
+    1) 先以 read-only 掃過所有來源檔的 REQUEST_TABLE 與各年 header，做年份 / 變數數量檢查
+    2) 再依年份排序，逐張工作表讀一列、寫一列到 write-only workbook，
+       COUNTRY 三欄在寫出時才補上，記憶體不隨年數成長
+    3) 年份完整性 / 連續性最後才知道，通過才存檔（先寫暫存檔再 rename）
+    """
+    print(f"\nProcessing {country}...")
+
+    display_country = country.replace("-", " ") # 取得 COUNTRY 欄
 
-        # ---- 掃描該國所有來源檔 ----
+    workbooks = {}          # fname -> read-only workbook，寫完才關
+    entries = []            # (year, fname, sheet_name, perm)，只記位置不讀資料
+    header = None
+    reference = None        # 第一個採用年度的 (year, 欄名, 指紋)，其他年度依此對齊
+    expected_cols = None    # 紀錄該國家應有的欄位數
+    year_col_count = {}     # 紀錄每年欄位數（方便報錯）
+
+    try:
+        # ---- 掃描該國所有來源檔（只讀 REQUEST_TABLE 與 header）----
         for fname in files:
             path = os.path.join(SRC_DIR, fname)
-            wb = load_workbook(path, data_only=True)
+            wb = load_workbook(path, read_only=True, data_only=True)
 
             if "REQUEST_TABLE" not in wb.sheetnames:
                 wb.close()
                 print(f"❌ 缺少 REQUEST_TABLE！略過國家：{country}")
                 continue
 
-            req_ws = wb["REQUEST_TABLE"]
-            row = 7
-
-            # REQUEST_TABLE 從第 7 列一直往下讀，讀到空白就停
-            while True:
-                file_years = parse_years_from_filename(fname)
-
-                year = req_ws[f"G{row}"].value
-                ref = req_ws[f"K{row}"].value
-
-                if year is None or ref is None:
-                    break
-
-                year = int(year)
+            workbooks[fname] = wb
+            file_years = parse_years_from_filename(fname)
 
+            for year, ref, rows_value, cols_value in iter_request_table(wb["REQUEST_TABLE"]):
                 # ====== 檔名 vs REQUEST_TABLE 年份檢查 ======
                 if year not in file_years:
                     print(
@@ -113,134 +318,330 @@ def main():
                         f"| REQUEST_TABLE 年份: {year} "
                         f"| 檔名年份: {sorted(file_years)} → 已跳過"
                     )
-                    row += 1
                     continue
 
-                if START_YEAR <= year <= END_YEAR:
-                    sheet_name = extract_sheet_name(ref)
-
-                    if sheet_name in wb.sheetnames:
-                        src_ws = wb[sheet_name]
-                        raw_rows = list(src_ws.iter_rows(values_only=True))
-                        rows = [
-                            r for r in raw_rows
-                            if any(cell is not None for cell in r) # Excel 被更動過會殘留「看不見的空白列」，需自動丟棄
-                        ]
-
-                        # 若有丟棄空白列，印警告
-                        if len(rows) < len(raw_rows):
-                            print(
-                                f"⚠ 警告｜{country} {year} 年："
-                                f"工作表包含 {len(raw_rows)-len(rows)} 列殘留空白列，已自動移除"
-                            )
-
-                        if not rows:
-                            row += 1
-                            continue
-
-                        # ====== 確保同一國家變數數量都一樣 ======
-                        # 優先檢查 REQUEST_TABLE O 欄
-                        # 備援：實際去數後面工作表欄位 - 1
-                        cols_value = req_ws[f"O{row}"].value
-                        rows_value = req_ws[f"N{row}"].value
-                        print(
-                            f"國家: {country} | 年份: {year} "
-                            f"| O欄(cols_value) = {cols_value} "
-                            f"| N欄(rows_value) = {rows_value}"
-                            f"| 工作表列數={len(rows)}"
-                        )
-
-                        if isinstance(cols_value, int):
-                            n_cols = cols_value
-                        else:
-                            n_cols = src_ws.max_column
-                        number_of_variables = n_cols - 1 # 排除 Type (DSCD)
-
-                        year_col_count[year] = n_cols
-
-                        if expected_cols is None:
-                            expected_cols = number_of_variables # 紀錄該國第一年變數數量
-                        else:
-                            if number_of_variables != expected_cols:
-                                print(f"❌ 變數數量不一致，已略過該年份！國家：{country} 年份：{year}")
-                                print(f"  期望變數數量（不含 Type/DSCD）：{expected_cols}")
-                                print(f"  年份 {year} 變數數量：{number_of_variables}")
-                                print("  各年變數數量（不含 Type/DSCD）：")
-                                for y, c in year_col_count.items():
-                                    print(f"   - {y}: {c-1}")
-                                row += 1
-                                continue # 跳回 while True 的開頭，跑下一年
-                        # ====== 檢查結束 ======
-
-                        if header is None:
-                            header = ["YEAR"] + list(rows[0]) # 第一次跑該國時，紀錄欄位名稱
-
-                        for data_row in rows[1:]:
-                            records.append([year] + list(data_row)) # 把「某一年的資料」一筆一筆加進 MASTER_TABLE
-
-                row += 1
+                if not START_YEAR <= year <= END_YEAR:
+                    continue
 
-            wb.close()
+                sheet_name = extract_sheet_name(ref)
+                if sheet_name not in wb.sheetnames:
+                    continue
 
-        if len(records) == 0:
+                src_ws = wb[sheet_name]
+                sheet_header, fingerprint = read_sheet_header(src_ws)
+                if sheet_header is None:
+                    continue
+
+                # ====== 確保同一國家變數數量都一樣 ======
+                # 優先檢查 REQUEST_TABLE O 欄
+                # 備援：實際去數後面工作表欄位 - 1
+                print(
+                    f"國家: {country} | 年份: {year} "
+                    f"| O欄(cols_value) = {cols_value} "
+                    f"| N欄(rows_value) = {rows_value}"
+                )
+
+                if isinstance(cols_value, int):
+                    n_cols = cols_value
+                else:
+                    n_cols = src_ws.max_column or len(sheet_header)
+                number_of_variables = n_cols - 1 # 排除 Type (DSCD)
+
+                year_col_count[year] = n_cols
+
+                if expected_cols is None:
+                    expected_cols = number_of_variables # 紀錄該國第一年變數數量
+                elif number_of_variables != expected_cols:
+                    print(f"❌ 變數數量不一致，已略過該年份！國家：{country} 年份：{year}")
+                    print(f"  期望變數數量（不含 Type/DSCD）：{expected_cols}")
+                    print(f"  年份 {year} 變數數量：{number_of_variables}")
+                    print("  各年變數數量（不含 Type/DSCD）：")
+                    for y, c in year_col_count.items():
+                        print(f"   - {y}: {c-1}")
+                    continue
+                # ====== 檢查結束 ======
+
+                # ====== header 指紋不同：欄名相同只是順序不同就重排，否則略過 ======
+                perm = None
+                if reference is None:
+                    reference = (year, header_names(sheet_header), fingerprint)
+                elif fingerprint != reference[2]:
+                    ref_year, ref_names, _ = reference
+                    names = header_names(sheet_header)
+                    perm = column_permutation(ref_names, names)
+                    if perm is None:
+                        print_header_mismatch(country, year, ref_year, ref_names, names)
+                        continue
+                    print(f"🔀 {country} {year} 年欄位順序與 {ref_year} 年不同，已依欄名重新對齊")
+
+                if header is None:
+                    header = ["YEAR"] + list(sheet_header) # 第一次跑該國時，紀錄欄位名稱
+
+                entries.append((year, fname, sheet_name, perm))
+
+        if not entries:
             print(f"  ⚠ {country} 無有效資料，略過")
+            return
+
+        # ---- 依年份升冪排序（同年維持讀取順序）----
+        entries.sort(key=lambda e: e[0])
+
+        country_code, country_code2 = lookup_country_codes(display_country, country_code_map)
+
+        out_wb = Workbook(write_only=True)
+        out_ws = out_wb.create_sheet("MASTER_TABLE")
+        out_ws.append(country_header(header))
+
+        n_records = 0
+        years_present = set()
+        panel = PanelPresence(header[1:])
+
+        # ---- 逐年串流寫出 ----
+        for year, fname, sheet_name, perm in entries:
+            n_rows, blank_rows = stream_sheet_rows(
+                out_ws, workbooks[fname][sheet_name],
+                [year, display_country, country_code, country_code2],
+                perm,
+                panel,
+            )
+
+            # 若有丟棄空白列，印警告
+            if blank_rows:
+                print(
+                    f"⚠ 警告｜{country} {year} 年："
+                    f"工作表包含 {blank_rows} 列殘留空白列，已自動移除"
+                )
+            print(f"國家: {country} | 年份: {year} | 工作表列數={n_rows + 1}")
+
+            if n_rows:
+                years_present.add(year)
+            n_records += n_rows
+    finally:
+        for wb in workbooks.values():
+            wb.close()
+
+    if n_records == 0:
+        print(f"  ⚠ {country} 無有效資料，略過")
+        return
+
+    # ---- 取得實際年份範圍 ----
+    years_present = sorted(years_present)
+
+    if not check_years(country, years_present):
+        return  # 跳過該國家，不輸出
+
+    # ---- 輸出主控表（先寫暫存檔再 rename，不留下寫到一半的檔案）----
+    out_path = os.path.join(
+        OUT_DIR, f"{country}-{years_present[0]}-{years_present[-1]}.xlsx"
+    )
+    tmp_path = out_path + ".tmp"
+    out_wb.save(tmp_path)
+    os.replace(tmp_path, out_path)
+
+    print(f"  ✔ 輸出完成: {out_path}，共 {n_records} 筆資料")
+    write_panel_report(panel, country, out_path)
+
+def integrate_country_inplace(country, files, country_code_map):
+    """整國各年度資料先讀進 SheetBuffer，排序後一次寫出"""
+    print(f"\nProcessing {country}...")
+
+    display_country = country.replace("-", " ") # 取得 COUNTRY 欄
+
+    blocks = []             # 暫存 某個國家 各年度的資料 (year, SheetBuffer)
+    header = None
+    reference = None        # 第一個採用年度的 (year, 欄名, 指紋)，其他年度依此對齊
+    expected_cols = None    # 紀錄該國家應有的欄位數
+    year_col_count = {}     # 紀錄每年欄位數（方便報錯）
+
+    # ---- 掃描該國所有來源檔 ----
+    for fname in files:
+        path = os.path.join(SRC_DIR, fname)
+        wb = load_workbook(path, read_only=True, data_only=True)
+
+        if "REQUEST_TABLE" not in wb.sheetnames:
+            wb.close()
+            print(f"❌ 缺少 REQUEST_TABLE！略過國家：{country}")
             continue
 
-        # ---- 加 COUNTRY / COUNTRY_CODE / COUNTRY_CODE2 ----
-        code_info = country_code_map.get(display_country, {"Country_code": "", "Country_code2": ""})
-        country_code = code_info.get("Country_code", "")
-        country_code2 = code_info.get("Country_code2", "")
-
-        # 調整 header，把三欄插到 YEAR 之後
-        new_header = header[:1] + ["COUNTRY", "COUNTRY_CODE", "COUNTRY_CODE2"] + header[1:]
-
-        # 調整每筆資料
-        new_records = []
-        for row in records:
-            new_row = row[:1] + [display_country, country_code, country_code2] + row[1:]
-            new_records.append(new_row)
-
-        # ---- 依年份升冪排序 ----
-        new_records.sort(key=lambda x: x[0])
-
-        # ---- 取得實際年份範圍 ----
-        years_present = sorted({row[0] for row in new_records})
-
-        # ---- 檢查年份完整性 ----
-        required_years = set(range(START_YEAR, END_YEAR + 1))
-        missing_required = sorted(required_years - set(years_present))
-
-        # ---- 檢查年份連續性 ----
-        min_year = min(years_present)
-        max_year = max(years_present)
-        full_range = set(range(min_year, max_year + 1))
-        missing_continuous = sorted(full_range - set(years_present))
-
-        # ---- 若任一條件不符合就跳過 ----
-        if missing_required or missing_continuous:
-            msg = f"⚠ {country} 資料不完整或不連續｜實際年份: {years_present}"
-            if missing_required:
-                msg += f" | 年份不完整，缺少: {', '.join(str(y) for y in missing_required)}"
-            if missing_continuous:
-                msg += f" | 年份不連續，缺少: {', '.join(str(y) for y in missing_continuous)}"
-            print(msg)
-            continue  # 跳過該國家，不輸出
-
-        # ---- 輸出主控表 ----
-        out_wb = Workbook()
-        out_ws = out_wb.active
-        out_ws.title = "MASTER_TABLE"
-
-        out_ws.append(new_header)
-        for r in new_records:
-            out_ws.append(r)
-
-        out_path = os.path.join(
-            OUT_DIR, f"{country}-{min_year}-{max_year}.xlsx"
-        )
-        out_wb.save(out_path)
-
-        print(f"  ✔ 輸出完成: {out_path}，共 {len(new_records)} 筆資料")
+        file_years = parse_years_from_filename(fname)
+
+        for year, ref, rows_value, cols_value in iter_request_table(wb["REQUEST_TABLE"]):
+            # ====== 檔名 vs REQUEST_TABLE 年份檢查 ======
+            if year not in file_years:
+                print(
+                    f"❌ 年份不一致｜檔名: {fname} "
+                    f"| REQUEST_TABLE 年份: {year} "
+                    f"| 檔名年份: {sorted(file_years)} → 已跳過"
+                )
+                continue
+
+            if not START_YEAR <= year <= END_YEAR:
+                continue
+
+            sheet_name = extract_sheet_name(ref)
+            if sheet_name not in wb.sheetnames:
+                continue
+
+            src_ws = wb[sheet_name]
+
+            # 依 N x O 預先配置，逐列填入
+            buf = SheetBuffer.from_sheet(
+                src_ws,
+                rows_value if isinstance(rows_value, int) else 0,
+                cols_value if isinstance(cols_value, int) else 0,
+            )
+
+            # 若有丟棄空白列，印警告
+            if buf.blank_rows:
+                print(
+                    f"⚠ 警告｜{country} {year} 年："
+                    f"工作表包含 {buf.blank_rows} 列殘留空白列，已自動移除"
+                )
+
+            if buf.header is None:
+                continue
+
+            # ====== 確保同一國家變數數量都一樣 ======
+            # 優先檢查 REQUEST_TABLE O 欄
+            # 備援：實際去數後面工作表欄位 - 1
+            print(
+                f"國家: {country} | 年份: {year} "
+                f"| O欄(cols_value) = {cols_value} "
+                f"| N欄(rows_value) = {rows_value}"
+                f"| 工作表列數={buf.rows + 1}"
+            )
+
+            if isinstance(cols_value, int):
+                n_cols = cols_value
+            else:
+                n_cols = src_ws.max_column or max(len(buf.header), buf.cols)
+            number_of_variables = n_cols - 1 # 排除 Type (DSCD)
+
+            year_col_count[year] = n_cols
+
+            if expected_cols is None:
+                expected_cols = number_of_variables # 紀錄該國第一年變數數量
+            elif number_of_variables != expected_cols:
+                print(f"❌ 變數數量不一致，已略過該年份！國家：{country} 年份：{year}")
+                print(f"  期望變數數量（不含 Type/DSCD）：{expected_cols}")
+                print(f"  年份 {year} 變數數量：{number_of_variables}")
+                print("  各年變數數量（不含 Type/DSCD）：")
+                for y, c in year_col_count.items():
+                    print(f"   - {y}: {c-1}")
+                continue
+            # ====== 檢查結束 ======
+
+            # ====== header 指紋不同：欄名相同只是順序不同就重排，否則略過 ======
+            names = header_names(buf.header)
+            fingerprint = header_fingerprint(names)
+            if reference is None:
+                reference = (year, names, fingerprint)
+            elif fingerprint != reference[2]:
+                ref_year, ref_names, _ = reference
+                perm = column_permutation(ref_names, names)
+                if perm is None:
+                    print_header_mismatch(country, year, ref_year, ref_names, names)
+                    continue
+                print(f"🔀 {country} {year} 年欄位順序與 {ref_year} 年不同，已依欄名重新對齊")
+                buf.reorder(perm)
+
+            if header is None:
+                header = ["YEAR"] + list(buf.header) # 第一次跑該國時，紀錄欄位名稱
+
+            blocks.append((year, buf)) # 整張年度資料一次加進 MASTER_TABLE
+
+        wb.close()
+
+    n_records = sum(buf.rows for _, buf in blocks)
+    if n_records == 0:
+        print(f"  ⚠ {country} 無有效資料，略過")
+        return
+
+    # ---- 加 COUNTRY / COUNTRY_CODE / COUNTRY_CODE2 ----
+    country_code, country_code2 = lookup_country_codes(display_country, country_code_map)
+
+    # 調整 header，把三欄插到 YEAR 之後
+    new_header = country_header(header)
+
+    # ---- 依年份升冪排序（同年維持讀取順序）----
+    blocks.sort(key=lambda b: b[0])
+
+    # ---- 預先配置整個 MASTER_TABLE，各年度資料以切片整塊填入 ----
+    width = max(buf.cols for _, buf in blocks)
+    table = np.empty((n_records, 4 + width), dtype=object)
+    table[:, 1] = display_country
+    table[:, 2] = country_code
+    table[:, 3] = country_code2
+
+    panel = PanelPresence(header[1:])
+
+    pos = 0
+    for year, buf in blocks:
+        table[pos:pos + buf.rows, 0] = year
+        table[pos:pos + buf.rows, 4:4 + buf.cols] = buf.data()
+        if panel.type_idx < buf.cols:
+            panel.add_column(buf.data()[:, panel.type_idx], year)
+        pos += buf.rows
+
+    # ---- 取得實際年份範圍 ----
+    years_present = sorted({year for year, buf in blocks if buf.rows})
+
+    if not check_years(country, years_present):
+        return  # 跳過該國家，不輸出
+
+    # ---- 輸出主控表 ----
+    out_wb = Workbook()
+    out_ws = out_wb.active
+    out_ws.title = "MASTER_TABLE"
+
+    out_ws.append(new_header)
+    for r in table:
+        out_ws.append(r.tolist())
+
+    out_path = os.path.join(
+        OUT_DIR, f"{country}-{years_present[0]}-{years_present[-1]}.xlsx"
+    )
+    out_wb.save(out_path)
+
+    print(f"  ✔ 輸出完成: {out_path}，共 {n_records} 筆資料")
+    write_panel_report(panel, country, out_path)
+
+def integrate_country(country, files, country_code_map):
+    if STREAMING:
+        integrate_country_streaming(country, files, country_code_map)
+    else:
+        integrate_country_inplace(country, files, country_code_map)
+
+def main():
+    # ========= 收集各國檔案 =========
+    country_files = defaultdict(list)
+
+    for f in os.listdir(SRC_DIR):
+        if f.lower().endswith((".xlsm", ".xlsx")):
+            country_files[parse_country(f)].append(f)
+
+    # ---- 讀 country code 對照表 ----
+    code_df = pd.read_excel(os.path.join(BASE_DIR, "country-code.xlsx"))
+    code_df["Country_name"] = code_df["Country_name"].str.strip()
+
+    country_code_map = code_df.set_index("Country_name").to_dict(orient="index")
+
+    # ========= 主流程 =========
+    if WORKERS > 1:
+        # country-code 對照表只讀一次，隨 task 傳給 worker
+        tasks = [
+            (country, files, country_code_map)
+            for country, files in country_files.items()
+        ]
+        with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+            for log_text, _, error in executor.map(partial(run_buffered, integrate_country), tasks):
+                print(log_text, end="")
+                if error is not None:
+                    executor.shutdown(cancel_futures=True)
+                    raise error
+    else:
+        for country, files in country_files.items():
+            integrate_country(country, files, country_code_map)
 
     print("=== 全部國家彙整完成 ===")
 
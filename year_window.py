@@ -0,0 +1,5 @@
+# ========= 整合的年度區間 =========
+# entity-integrate.py、variable-integrate.py、year-integrate.py 共用，只要改這裡
+# 區間外的年度工作表不讀、不輸出；year-integrate.py 檢查每個國家這些年度都要有
+START_YEAR = 2015
+END_YEAR = 2024